@@ -0,0 +1,440 @@
+"""
+EBS volume modification polling and rollback, shared by emp/migrate_to_io2.py
+and pmk/scripts/migrate_awsvolumes/migrate_ebs_volume_gp2_to_gp3.py. The
+scripts look for this module next to themselves first, then in this
+directory, so a script copied elsewhere runs with a copy of this file beside it.
+
+ModificationPoller follows every in-flight modification of a region from one
+thread, with batched describe_volumes_modifications calls (see PollBackoff).
+
+Every run snapshots the original attributes of each volume it modifies into
+<prefix><run-id>.jsonl (RunLog), and `--rollback <run-id>` reverts the volumes
+that changed since (VolumeRollback). EC2 allows one modification per volume
+every 6 hours, so volumes are queued until their cooldown ends.
+"""
+
+import concurrent.futures
+import datetime
+import heapq
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import botocore.exceptions
+
+logger = logging.getLogger('PF9')
+
+
+class RunLog:
+    """
+    JSON-lines record of one run: the original attributes of every volume,
+    snapshotted before it is modified, and its outcome. It is what
+    --rollback <run-id> reverts from.
+    """
+
+    def __init__(self, run_id, run_dir=".", prefix="io2-run-"):
+        self.run_id = run_id
+        self.path = os.path.join(run_dir, "{}{}.jsonl".format(prefix, run_id))
+        self.volumes = {}
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Last line may be torn if the previous run was killed
+                        continue
+                    self.volumes.setdefault(entry["id"], {}).update(entry)
+        self._file = None
+
+    def record(self, volume_id, state, **extra):
+        entry = dict(extra, id=volume_id, state=state, time=time.time())
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a")
+            self.volumes.setdefault(volume_id, {}).update(entry)
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+
+    def snapshot(self, volume_id, region_id, volume_info, **extra):
+        # Keep the first snapshot if the run id is reused, later ones may already be converted
+        if "volume" in self.volumes.get(volume_id, {}):
+            self.record(volume_id, "pending")
+        else:
+            self.record(volume_id, "pending", region=region_id,
+                        volume=volume_attributes(volume_info), **extra)
+
+    def originals(self, region_id, **match):
+        """{volume_id: original attributes} of the volumes snapshotted in region_id (and matching `match`)."""
+        return {volume_id: record["volume"] for volume_id, record in self.volumes.items()
+                if "volume" in record and record.get("region") == region_id and
+                all(record.get(key) == value for key, value in match.items())}
+
+    def regions(self):
+        return sorted(set(record["region"] for record in self.volumes.values() if "region" in record))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def volume_attributes(volume_info):
+    return {key: volume_info[key] for key in ("VolumeType", "Size", "Iops", "Throughput", "MultiAttachEnabled")
+            if volume_info.get(key) is not None}
+
+
+def revert_parameters(original, current):
+    """modify_volume arguments bringing `current` back to `original`, {} when it is unchanged."""
+    params = {}
+    if current["VolumeType"] != original["VolumeType"]:
+        params["VolumeType"] = original["VolumeType"]
+    # gp2 and st1/sc1 don't take provisioned IOPS/throughput
+    if original["VolumeType"] in ("io1", "io2", "gp3") and original.get("Iops") and \
+            current.get("Iops") != original["Iops"]:
+        params["Iops"] = original["Iops"]
+    if original["VolumeType"] == "gp3" and original.get("Throughput") and \
+            current.get("Throughput") != original["Throughput"]:
+        params["Throughput"] = original["Throughput"]
+    # Only when snapshotted, a snapshot without it says nothing about Multi-Attach
+    if "MultiAttachEnabled" in original and \
+            bool(current.get("MultiAttachEnabled")) != bool(original["MultiAttachEnabled"]):
+        params["MultiAttachEnabled"] = bool(original["MultiAttachEnabled"])
+    return params
+
+
+class VolumeRollback:
+    """
+    Reverts volumes to their snapshotted attributes, max_parallel at a time.
+    A volume is queued until 6 hours after its last modification started, and
+    requeued if EC2 still refuses it (e.g. the modification is still
+    optimizing). wait(volume_id) blocks on the volume's modification and
+    returns it, or None if EC2 doesn't know it.
+    """
+    COOLDOWN_SECONDS = 6 * 3600
+    RETRY_SECONDS = 300
+    RETRY_CODES = ("VolumeModificationRateExceeded", "IncorrectModificationState")
+    BATCH_SIZE = 200
+
+    def __init__(self, ec2_client, wait, run_log=None, max_parallel=10):
+        self.ec2_client = ec2_client
+        self.wait = wait
+        self.run_log = run_log
+        self.max_parallel = max_parallel
+
+    def _batches(self, volume_ids):
+        for i in range(0, len(volume_ids), self.BATCH_SIZE):
+            # Unlike VolumeIds, a volume-id filter doesn't fail the call on an unknown id
+            yield [{"Name": "volume-id", "Values": volume_ids[i:i + self.BATCH_SIZE]}]
+
+    def current_volumes(self, volume_ids):
+        volumes = {}
+        paginator = self.ec2_client.get_paginator("describe_volumes")
+        for filters in self._batches(volume_ids):
+            for page in paginator.paginate(Filters=filters):
+                for volume_info in page["Volumes"]:
+                    volumes[volume_info["VolumeId"]] = volume_info
+        return volumes
+
+    def eligible_times(self, volume_ids):
+        eligible = {}
+        paginator = self.ec2_client.get_paginator("describe_volumes_modifications")
+        for filters in self._batches(volume_ids):
+            # The filter skips never modified volumes instead of failing the call
+            for page in paginator.paginate(Filters=filters):
+                for modification in page["VolumesModifications"]:
+                    eligible[modification["VolumeId"]] = \
+                        modification["StartTime"].timestamp() + self.COOLDOWN_SECONDS
+        return eligible
+
+    def revert(self, volume_id, params):
+        """Returns True/False, or None when EC2 refuses the modification for now."""
+        try:
+            logger.info("Reverting volume %s: %s", volume_id, params)
+            self.ec2_client.modify_volume(VolumeId=volume_id, **params)
+        except botocore.exceptions.ClientError as err:
+            if err.response["Error"]["Code"] in self.RETRY_CODES:
+                return None
+            logger.error("Failed to revert volume %s: %s", volume_id, err)
+            return False
+        try:
+            modification = self.wait(volume_id)
+        except Exception as err:
+            logger.error("Failed to revert volume %s: %s", volume_id, err)
+            return False
+        if modification is not None and modification["ModificationState"] == "failed":
+            logger.error("Failed to revert volume %s: %s", volume_id, modification.get("StatusMessage"))
+            return False
+        logger.info("Reverted volume %s", volume_id)
+        return True
+
+    def run(self, originals):
+        """Reverts the changed volumes of {volume_id: original attributes}, returns {volume_id: bool}."""
+        results, pending = {}, {}
+        current = self.current_volumes(list(originals))
+        for volume_id, original in originals.items():
+            if volume_id not in current:
+                logger.error("Volume %s no longer exists, cannot revert it", volume_id)
+                results[volume_id] = False
+                continue
+            params = revert_parameters(original, current[volume_id])
+            if params:
+                pending[volume_id] = params
+            else:
+                logger.info("Volume %s is unchanged, nothing to revert", volume_id)
+        eligible = self.eligible_times(list(pending))
+        queue = [(eligible.get(volume_id, 0), volume_id) for volume_id in pending]
+        heapq.heapify(queue)
+        logger.info("Reverting %s of %s volumes, %s queued until their 6 hour modification cooldown ends",
+                    len(pending), len(originals), len([at for at, _ in queue if at > time.time()]))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_parallel) as executor:
+            futures = {}
+            while queue or futures:
+                while queue and queue[0][0] <= time.time():
+                    _, volume_id = heapq.heappop(queue)
+                    futures[executor.submit(self.revert, volume_id, pending[volume_id])] = volume_id
+                timeout = max(0, queue[0][0] - time.time()) if queue else None
+                if not futures:
+                    logger.info("Next volume %s becomes eligible in %.0fs", queue[0][1], timeout)
+                    time.sleep(timeout)
+                    continue
+                done, _ = concurrent.futures.wait(futures, timeout=timeout,
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    volume_id = futures.pop(future)
+                    ok = future.result()
+                    if ok is None:
+                        logger.info("Volume %s cannot be modified yet, retrying in %ss",
+                                    volume_id, self.RETRY_SECONDS)
+                        heapq.heappush(queue, (time.time() + self.RETRY_SECONDS, volume_id))
+                        continue
+                    results[volume_id] = ok
+                    if self.run_log is not None:
+                        self.run_log.record(volume_id, "rolled-back" if ok else "rollback-failed")
+
+        failed = [volume_id for volume_id, ok in results.items() if not ok]
+        logger.info("Reverted %s of %s volumes", len(results) - len(failed), len(results))
+        if failed:
+            logger.error("Failed to revert volumes: %s", failed)
+        return results
+
+
+class PollBackoff:
+    """
+    Picks the next poll interval for a volume modification from its reported
+    Progress and elapsed time, and a jittered exponential delay when EC2
+    throttles the poller.
+    """
+
+    def __init__(self, min_interval=5, max_interval=300, throttle_base=2,
+                 throttle_cap=120):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.throttle_base = throttle_base
+        self.throttle_cap = throttle_cap
+
+    def next_interval(self, modification):
+        start_time = modification.get("StartTime")
+        elapsed = 0
+        if start_time is not None:
+            elapsed = (datetime.datetime.now(start_time.tzinfo) -
+                       start_time).total_seconds()
+        progress = modification.get("Progress") or 0
+        if 0 < progress < 100 and elapsed > 0:
+            # Check back at about half the estimated remaining time
+            interval = elapsed * (100 - progress) / progress / 2
+        else:
+            interval = elapsed / 4
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def throttled(self, attempt):
+        return random.uniform(
+            0, min(self.throttle_cap, self.throttle_base * 2 ** attempt))
+
+
+THROTTLE_CODES = ("RequestLimitExceeded", "Throttling")
+
+
+def is_throttled(err):
+    return err.response["Error"]["Code"] in THROTTLE_CODES
+
+
+class ModificationPoller:
+    """
+    Single background poller shared by every migration thread.
+
+    All in-flight volume ids are refreshed together with batched
+    describe_volumes_modifications calls, and each waiting thread blocks on a
+    per-volume event instead of running its own sleep loop. Each volume is
+    re-polled on its own adaptive schedule (see PollBackoff).
+
+    A waiter can be released once the volume reaches an earlier state
+    (wait_for="optimizing"); the poller keeps following the volume until it
+    completes or fails, see drain(). Until its waiter is released such a
+    volume is polled every min_interval, Progress only tells when the whole
+    modification completes.
+    """
+    BATCH_SIZE = 200
+    TERMINAL_STATES = ("completed", "failed")
+    STATE_ORDER = {"modifying": 0, "optimizing": 1, "completed": 2, "failed": 2}
+
+    def __init__(self, ec2_client, backoff=None, on_update=None):
+        self.ec2_client = ec2_client
+        self.backoff = backoff or PollBackoff()
+        self.on_update = on_update
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._events = {}
+        self._release = {}
+        self._callbacks = {}
+        self._results = {}
+        self._next_poll = {}
+        self._throttle_attempts = 0
+        self._thread = None
+
+    def track(self, volume_id, wait_for="completed", on_update=None):
+        with self._lock:
+            if volume_id not in self._events:
+                self._events[volume_id] = threading.Event()
+                self._results.pop(volume_id, None)
+                self._wakeup.set()
+            if on_update is not None:
+                self._callbacks[volume_id] = on_update
+            if volume_id not in self._release:
+                self._release[volume_id] = (threading.Event(), wait_for)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            return self._release[volume_id][0]
+
+    def wait(self, volume_id, wait_for="completed", on_update=None):
+        self.track(volume_id, wait_for, on_update).wait()
+        with self._lock:
+            modification, error = self._results[volume_id]
+        if error is not None:
+            raise error
+        return modification
+
+    def drain(self, volume_ids=None):
+        """Block until every tracked volume (or the given ones) has completed or failed."""
+        while True:
+            with self._lock:
+                events = [event for volume_id, event in self._events.items()
+                          if volume_ids is None or volume_id in volume_ids]
+            if not events:
+                return
+            for event in events:
+                event.wait()
+
+    def _pending(self):
+        with self._lock:
+            volume_ids = [volume_id for volume_id, event in self._events.items()
+                          if not event.is_set()]
+            if not volume_ids:
+                self._thread = None
+            return volume_ids
+
+    def _run(self):
+        volume_ids = self._pending()
+        while volume_ids:
+            self._wakeup.clear()
+            now = time.time()
+            # Also take volumes due shortly so their polls share a batch
+            due = [volume_id for volume_id in volume_ids
+                   if self._next_poll.get(volume_id, 0) <= now + self.backoff.min_interval]
+            for i in range(0, len(due), self.BATCH_SIZE):
+                self._refresh(due[i:i + self.BATCH_SIZE])
+            volume_ids = self._pending()
+            if not volume_ids:
+                return
+            next_poll = min(self._next_poll.get(volume_id, 0)
+                            for volume_id in volume_ids)
+            self._wakeup.wait(max(0, next_poll - time.time()))
+            volume_ids = self._pending()
+
+    def _describe(self, volume_ids):
+        paginator = self.ec2_client.get_paginator(
+            "describe_volumes_modifications")
+        modifications = []
+        # Filtering on volume-id skips volumes without a modification instead
+        # of failing the whole batch with NotFound like VolumeIds does
+        for page in paginator.paginate(
+                Filters=[{"Name": "volume-id", "Values": volume_ids}]):
+            modifications.extend(page["VolumesModifications"])
+        return modifications
+
+    def _refresh(self, volume_ids):
+        try:
+            modifications = self._describe(volume_ids)
+        except botocore.exceptions.ClientError as err:
+            if is_throttled(err):
+                self._throttle_attempts += 1
+                delay = self.backoff.throttled(self._throttle_attempts)
+                logger.warning("Throttled while polling %s volumes, retrying in %.1fs",
+                               len(volume_ids), delay)
+                for volume_id in volume_ids:
+                    self._next_poll[volume_id] = time.time() + delay
+                return
+            self._fail(volume_ids, err)
+            return
+        except Exception as err:
+            self._fail(volume_ids, err)
+            return
+
+        self._throttle_attempts = 0
+        for modification in modifications:
+            volume_id = modification["VolumeId"]
+            logger.info("Polling volume(%s) status: %s, progress: %s", volume_id,
+                        modification["ModificationState"], modification.get("Progress"))
+            on_update = self._callbacks.get(volume_id, self.on_update)
+            if on_update is not None:
+                on_update(volume_id, modification)
+            if modification["ModificationState"] in self.TERMINAL_STATES:
+                self._resolve(volume_id, modification)
+            else:
+                interval = self.backoff.next_interval(modification)
+                if self._release_if_reached(volume_id, modification):
+                    # Progress estimates completion, not when the waited for state is reached
+                    interval = min(interval, self.backoff.min_interval)
+                self._next_poll[volume_id] = time.time() + interval
+        found = set(modification["VolumeId"] for modification in modifications)
+        for volume_id in volume_ids:
+            if volume_id not in found:
+                logger.warning("Modification for volume '%s' does not exist.", volume_id)
+                self._resolve(volume_id, None)
+
+    def _release_if_reached(self, volume_id, modification):
+        """Releases the waiter once its state is reached, returns True while it waits for an earlier state."""
+        state = modification["ModificationState"]
+        with self._lock:
+            release = self._release.get(volume_id)
+            if release is None:
+                return False
+            if self.STATE_ORDER.get(state, -1) < self.STATE_ORDER[release[1]]:
+                return release[1] not in self.TERMINAL_STATES
+            del self._release[volume_id]
+            self._results[volume_id] = (modification, None)
+        release[0].set()
+        return False
+
+    def _resolve(self, volume_id, modification, error=None):
+        with self._lock:
+            event = self._events.pop(volume_id, None)
+            release = self._release.pop(volume_id, None)
+            self._callbacks.pop(volume_id, None)
+            self._results[volume_id] = (modification, error)
+            self._next_poll.pop(volume_id, None)
+        if release is not None:
+            release[0].set()
+        if event is not None:
+            event.set()
+
+    def _fail(self, volume_ids, err):
+        logger.error("Failed to fetch modification status for volumes %s. Error: %s",
+                     volume_ids, str(err))
+        for volume_id in volume_ids:
+            self._resolve(volume_id, None, err)
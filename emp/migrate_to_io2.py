@@ -1,14 +1,22 @@
 import argparse
 import boto3
+import datetime
 import math
 import logging
-import time
 import botocore
-import threading
+import botocore.config
+import concurrent.futures
+import os
+import sys
 
-AWS_REGION_ID=''
-AWS_ACCESS_KEY_ID=''
-AWS_SECRET_ACCESS_KEY=''
+# Shared with the pmk gp2 to gp3 script, found next to this script or in the repository's ebs-common/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ebs-common"))
+try:
+    from ebs_common import ModificationPoller, PollBackoff, RunLog, VolumeRollback
+except ImportError as err:
+    if err.name != "ebs_common":
+        raise
+    sys.exit("ebs_common.py not found, copy ebs-common/ebs_common.py next to this script")
 
 logging.basicConfig(
     level=logging.INFO,
@@ -16,10 +24,27 @@ logging.basicConfig(
 )
 logger = logging.getLogger('PF9')
 
+def make_ec2_client(region_id=None, aws_access_key_id=None, aws_secret_access_key=None, profile=None, max_parallel=10):
+    """
+    EC2 client shared by all conversion threads of a region. The connection
+    pool is sized for the worker threads plus the poller and the selector, and
+    throttled calls are retried with botocore's adaptive (client side rate
+    limited) retry mode. Without keys the profile, or the default credential
+    chain, is used.
+    """
+    session = boto3.session.Session(aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key, profile_name=profile, region_name=region_id)
+    config = botocore.config.Config(max_pool_connections=max_parallel + 2, retries={"mode": "adaptive", "max_attempts": 10})
+    return session.client('ec2', config=config)
+
 class MigrateVolume:
-    def __init__(self):
-        self.ec2_client = boto3.client('ec2', aws_access_key_id=AWS_ACCESS_KEY_ID, aws_secret_access_key=AWS_SECRET_ACCESS_KEY, region_name=AWS_REGION_ID)
-        self.polltime = 30
+    DESCRIBE_BATCH_SIZE = 200
+
+    def __init__(self, ec2_client=None, backoff=None, max_instance_iops=160000, run_log=None):
+        self.ec2_client = ec2_client or make_ec2_client()
+        self.run_log = run_log
+        self.backoff = backoff or PollBackoff()
+        self.poller = ModificationPoller(self.ec2_client, self.backoff)
+        self.max_instance_iops = max_instance_iops
 
     def calculate_iops(self, volume_size, iops_per_gb):
         iops = min(math.ceil(volume_size * iops_per_gb), 64000)
@@ -27,52 +52,61 @@ class MigrateVolume:
     
     def check_modification_status(self, volume_id):
         logger.info("Fetching modfication status for volume [%s].", volume_id)
-        try:
-            response = self.ec2_client.describe_volumes_modifications(VolumeIds=[volume_id])
-        except botocore.exceptions.ClientError as err:
-            if err.response["Error"]["Code"] == "InvalidVolumeModification.NotFound":
-                logger.warning(err.response["Error"]["Message"])
-                return
-            raise err
-
-        if len(response["VolumesModifications"]) < 1:
-            logger.warning("Volume with id (%s) Not Found", volume_id)
+        modification = self.poller.wait(volume_id)
+        if modification is None:
             return
 
-        while response["VolumesModifications"][0]["ModificationState"] != "completed" and response["VolumesModifications"][0]["ModificationState"] != "failed":
-            time.sleep(self.polltime)
-            response = self.ec2_client.describe_volumes_modifications(VolumeIds=[volume_id])
-            logger.info("Polling volume(%s) status: %s, progress: %s", volume_id, response["VolumesModifications"][0]["ModificationState"], response["VolumesModifications"][0]["Progress"])
+        timetaken = modification.get("EndTime", modification["StartTime"]) - modification["StartTime"]
+        logger.info("Volume modified: %s: %s. Total timetaken: %s", volume_id, modification["ModificationState"], timetaken)
+        if modification["ModificationState"] == "failed":
+            raise Exception("Volume {} modification failed: {}".format(volume_id, modification.get("StatusMessage")))
 
-        timetaken = response["VolumesModifications"][0]["EndTime"] - response["VolumesModifications"][0]["StartTime"]
-        logger.info("Volume modified: %s: %s. Total timetaken: %s", volume_id, response["VolumesModifications"][0]["ModificationState"], timetaken)
+    def describe_volumes(self, filters):
+        paginator = self.ec2_client.get_paginator("describe_volumes")
+        for page in paginator.paginate(Filters=filters):
+            for volume_info in page["Volumes"]:
+                yield volume_info
 
-    def modify_volume_to_io2(self, volume_id, iops_per_gb):
-        logger.info('Modifying volume %s to io2', volume_id)
+    def describe_volume_ids(self, volume_ids, filters=None):
+        """
+        Yields (volume_id, volume_info) for the given ids, fetched with batched
+        describe_volumes calls. volume_info is None for an id that does not
+        exist or does not match the extra filters.
+        """
+        for i in range(0, len(volume_ids), self.DESCRIBE_BATCH_SIZE):
+            batch = volume_ids[i:i + self.DESCRIBE_BATCH_SIZE]
+            # Unlike VolumeIds, a volume-id filter does not fail the whole call on an unknown id
+            volumes = {volume_info["VolumeId"]: volume_info for volume_info in self.describe_volumes([{"Name": "volume-id", "Values": batch}] + (filters or []))}
+            for volume_id in batch:
+                yield volume_id, volumes.get(volume_id)
 
+    def select_volumes(self, filters):
+        """
+        Streams (volume_id, volume_info) for every detached volume matching the
+        filters. Attached volumes can't get Multi-Attach, a selector sweep leaves
+        them out instead of failing on each of them.
+        """
+        for volume_info in self.describe_volumes(filters + [{"Name": "status", "Values": ["available"]}]):
+            yield volume_info["VolumeId"], volume_info
+
+    def preflight(self, volume_id, volume_info, iops_per_gb):
+        """
+        Returns the IOPS to convert the volume with, or None with the reason it
+        is rejected. Volumes already on io2 with Multi-Attach report no reason.
+        """
+        if volume_info is None:
+            return None, "volume not found or not matching the selectors"
+        attached = [attachment['InstanceId'] for attachment in volume_info.get('Attachments', []) if attachment['State'] != 'detached']
+        if attached:
+            return None, "volume attached to instance(s) {} and cannot be modified to enable Multi-Attach while attached".format(", ".join(attached))
+        if volume_info['VolumeType'] == 'io2' and volume_info.get('MultiAttachEnabled'):
+            return None, None
+        # Calculate iops based on the volume size and IOPS/GB
+        return self.calculate_iops(volume_info['Size'], iops_per_gb), None
+
+    def modify_volume_to_io2(self, volume_id, iops):
         try:
-            # Get volume info.
-            response = self.ec2_client.describe_volumes(VolumeIds=[volume_id])
-            
-            if len(response["Volumes"]) < 1:
-                logger.warning("Volume with id (%s) Not Found", volume_id)
-                return
-            volume_info = response['Volumes'][0]
-
-            # Check if the volume is attached anywhere if not process else throw error and exit
-            if len(volume_info['Attachments']) > 0:
-                for attachment in volume_info['Attachments']:
-                    if attachment['State'] == 'detached':
-                        logger.info('detached')
-                        continue
-                    else:
-                        logger.info('Failed to modify volume %s to io2 as volume already attached to an instance(%s) and cannot be modified to enable Multi-Attach while the volume is attached.', volume_id, attachment['InstanceId'])
-                        raise SystemExit
-
-            # Calculate iops based on the volume size and IOPS/GB
-            iops = self.calculate_iops(volume_info['Size'], iops_per_gb)
-
-            logger.info('Modifying volume %s to io2 with the following parameters:- IOPS/GB: %s, IOPS: %s', volume_id, iops_per_gb, iops)
+            logger.info('Modifying volume %s to io2 with IOPS: %s', volume_id, iops)
             # Modify the volume to io2 and set the IOPS and throughput.
             self.ec2_client.modify_volume(
                 VolumeId=volume_id,
@@ -84,21 +118,83 @@ class MigrateVolume:
             self.check_modification_status(volume_id)
 
             logger.info('Successfully modified volume %s to io2', volume_id)
+            return True
         except Exception as e:
             logger.error('Failed to modify volume %s to io2: %s', volume_id, e)
+            return False
+
+    def modify_volumes_to_io2(self, volume_ids, iops_per_gb, max_parallel=10, filters=None):
+        # Check every requested volume before converting any of them
+        volumes = list(self.describe_volume_ids(volume_ids, filters))
+        return self.convert_volumes(volumes, iops_per_gb, max_parallel)
 
-    def modify_volumes_to_io2(self, volume_ids, iops_per_gb):
-        threads = []
+    def convert_volumes(self, volumes, iops_per_gb, max_parallel=10):
+        """
+        Converts the (volume_id, volume_info) pairs of `volumes` as they are
+        consumed, so a paginated selection streams straight into the pool.
+        Detached volumes use no instance IOPS while converting, so the
+        per-instance limit is only checked against the total IOPS of the
+        selection, as if its Multi-Attach volumes were all attached together.
+        """
+        results = {}
+        rejected = already_io2 = total_iops = 0
+        seen = set()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            futures = {}
+            for volume_id, volume_info in volumes:
+                if volume_id in seen:
+                    continue
+                seen.add(volume_id)
+                iops, reason = self.preflight(volume_id, volume_info, iops_per_gb)
+                if iops is not None:
+                    total_iops += iops
+                    if total_iops > self.max_instance_iops >= total_iops - iops:
+                        logger.warning('Selected volumes total more than %s IOPS from volume %s on, more than an instance supports once they are attached together', self.max_instance_iops, volume_id)
+                    if self.run_log is not None:
+                        self.run_log.snapshot(volume_id, self.ec2_client.meta.region_name, volume_info)
+                    futures[executor.submit(self.modify_volume_to_io2, volume_id, iops)] = volume_id
+                elif reason is not None:
+                    logger.error('Skipping volume %s: %s', volume_id, reason)
+                    results[volume_id] = False
+                    rejected += 1
+                else:
+                    logger.info('Volume %s is already io2 with Multi-Attach enabled, skipping', volume_id)
+                    results[volume_id] = True
+                    already_io2 += 1
+            logger.info('Selected %s volumes: %s to convert (%s IOPS in total), %s rejected, %s already io2. IOPS/GB: %s', len(futures) + len(results), len(futures), total_iops, rejected, already_io2, iops_per_gb)
+            for future in concurrent.futures.as_completed(futures):
+                results[futures[future]] = future.result()
+                if self.run_log is not None:
+                    self.run_log.record(futures[future], "converted" if results[futures[future]] else "failed")
 
-        for volume_id in volume_ids:
-            thread = threading.Thread(target=self.modify_volume_to_io2, args=(volume_id, iops_per_gb))
-            threads.append(thread)
+        failed = [volume_id for volume_id, ok in results.items() if not ok]
+        logger.info('Converted %s of %s volumes to io2', len(results) - len(failed), len(results))
+        if failed:
+            logger.error('Failed to convert volumes: %s', failed)
+        return results
 
-        for t in threads:
-            t.start()
+def migrate_regions(migrators, volume_ids, filters, iops_per_gb, max_parallel=10):
+    """
+    Converts the selected volumes of every region ({region_id: MigrateVolume})
+    concurrently. Explicit volume ids are looked up in every region up front
+    and converted in the region they are found in.
+    """
+    if volume_ids:
+        selections, found = {}, set()
+        for region_id, migrateVol in migrators.items():
+            selections[region_id] = [(volume_id, volume_info) for volume_id, volume_info in migrateVol.describe_volume_ids(volume_ids, filters) if volume_info is not None]
+            found.update(volume_id for volume_id, _ in selections[region_id])
+        # Let the first region report the ids found nowhere
+        selections[next(iter(migrators))] += [(volume_id, None) for volume_id in volume_ids if volume_id not in found]
+    else:
+        selections = {region_id: migrateVol.select_volumes(filters) for region_id, migrateVol in migrators.items()}
 
-        for t in threads:
-            t.join()
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(migrators)) as executor:
+        futures = [executor.submit(migrators[region_id].convert_volumes, selection, iops_per_gb, max_parallel) for region_id, selection in selections.items()]
+        for future in concurrent.futures.as_completed(futures):
+            results.update(future.result())
+    return results
 
 def validate_iops_per_gb(iops_per_gb):
     if iops_per_gb < 1 or iops_per_gb > 500:
@@ -107,15 +203,33 @@ def validate_iops_per_gb(iops_per_gb):
     return iops_per_gb
 
 def validate_volume_ids(volume_ids):
-    if len(volume_ids) < 1:
-        logger.error('At least one volume ID is required')
-        raise SystemExit
     for volume_id in volume_ids:
         if volume_id == "":
             logger.error('Volume Id cannot be an empty string')
             raise SystemExit
     return volume_ids
 
+def validate_tag(value):
+    key, sep, tag_value = value.partition("=")
+    if not sep or key == "":
+        raise argparse.ArgumentTypeError("Tag must be given as key=value")
+    return key, tag_value
+
+def read_volume_ids(path):
+    # One volume id per line, blank lines and '#' comments are ignored
+    with open(path) as f:
+        return [line.split("#", 1)[0].strip() for line in f if line.split("#", 1)[0].strip()]
+
+def build_filters(tags, volume_types, availability_zones):
+    filters = []
+    for key, value in tags:
+        filters.append({"Name": "tag:{}".format(key), "Values": [value]})
+    if volume_types:
+        filters.append({"Name": "volume-type", "Values": volume_types})
+    if availability_zones:
+        filters.append({"Name": "availability-zone", "Values": availability_zones})
+    return filters
+
 def validate_empty_string(value):
     if value == "":
         raise argparse.ArgumentTypeError("Empty string is not allowed")
@@ -124,26 +238,75 @@ def validate_empty_string(value):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Modifies an EBS volume to io2 and sets the IOPS')
 
-    parser.add_argument('--aws_access_key_id', required=True, help='The AWS access key ID.', type=validate_empty_string)
-    parser.add_argument('--aws_secret_access_key', required=True, help='The AWS secret access key.', type=validate_empty_string)
-    parser.add_argument('--region_id', required=True, help='The AWS region id.', type=validate_empty_string)
+    parser.add_argument('--aws_access_key_id', help='The AWS access key ID. Defaults to the profile or the default credential chain.', type=validate_empty_string)
+    parser.add_argument('--aws_secret_access_key', help='The AWS secret access key.', type=validate_empty_string)
+    parser.add_argument('--profile', help='The AWS profile from the shared credentials file to use.', type=validate_empty_string)
+    parser.add_argument('--region_id', nargs='+', help='The AWS region id(s). Regions are converted concurrently.', type=validate_empty_string)
     parser.add_argument('--iops_per_gb', default=500, help='The IOPS/GB to set for the volume. Contraints: Max IOPS/GB: 500 IOPS/GB, Max IOPS/Volume: 64,000, Max IOPS/Instance: 160,000', type=int)
-    parser.add_argument('--volume_ids', required=True, nargs='+', help='The IDs of the EBS volumes to modify.')
+    parser.add_argument('--volume_ids', default=[], nargs='+', help='The IDs of the EBS volumes to modify.')
+    parser.add_argument('--from-file', help='File with the IDs of the EBS volumes to modify, one per line.')
+    parser.add_argument('--tag', default=[], action='append', type=validate_tag, help='Select volumes with this tag, as key=value. Can be repeated, all tags must match.')
+    parser.add_argument('--volume-type', default=[], action='append', help='Select volumes of this type, e.g. gp3. Can be repeated.')
+    parser.add_argument('--availability-zone', default=[], action='append', help='Select volumes in this availability zone. Can be repeated.')
+    parser.add_argument('--max-parallel', default=10, type=int, help='Maximum number of volumes converted at the same time.')
+    parser.add_argument('--max-instance-iops', default=160000, type=int, help='IOPS an instance supports (AWS Max IOPS/Instance). A warning is logged when the selected volumes total more, as they could not all be attached to one instance at full IOPS.')
+    parser.add_argument('--run-id', default=datetime.datetime.now().strftime("%Y%m%d-%H%M%S"), type=validate_empty_string, help='Name of this run, the original volume attributes are saved to io2-run-<run-id>.jsonl. Defaults to the current time.')
+    parser.add_argument('--run-dir', default=".", help='Directory for the io2-run-<run-id>.jsonl files.')
+    parser.add_argument('--rollback', metavar='RUN_ID', type=validate_empty_string, help='Revert the volumes changed by an earlier run to their original attributes, in the regions recorded for that run. Volumes modified less than 6 hours ago are queued until AWS allows modifying them again.')
 
     args = parser.parse_args()
 
     # Validate the arguments
+    if args.from_file:
+        args.volume_ids += read_volume_ids(args.from_file)
     args.volume_ids = validate_volume_ids(args.volume_ids)
     args.iops_per_gb = validate_iops_per_gb(args.iops_per_gb)
+    filters = build_filters(args.tag, args.volume_type, args.availability_zone)
+    if bool(args.aws_access_key_id) != bool(args.aws_secret_access_key):
+        parser.error('--aws_access_key_id and --aws_secret_access_key must be given together')
+    if args.rollback:
+        run_log = RunLog(args.rollback, args.run_dir)
+        if not run_log.volumes:
+            parser.error('No volumes recorded for run {} in {}'.format(args.rollback, run_log.path))
+        results = {}
+        try:
+            # Regions are reverted concurrently, each may have to wait out the cooldown
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(run_log.regions())) as executor:
+                futures = []
+                for region_id in run_log.regions():
+                    ec2_client = make_ec2_client(region_id, args.aws_access_key_id, args.aws_secret_access_key, args.profile, args.max_parallel)
+                    rollback = VolumeRollback(ec2_client, MigrateVolume(ec2_client).poller.wait, run_log, args.max_parallel)
+                    futures.append(executor.submit(rollback.run, run_log.originals(region_id)))
+                for future in concurrent.futures.as_completed(futures):
+                    results.update(future.result())
+        finally:
+            run_log.close()
+        if not all(results.values()):
+            raise SystemExit(1)
+        raise SystemExit(0)
 
-    AWS_REGION_ID=args.region_id
-    AWS_ACCESS_KEY_ID=args.aws_access_key_id
-    AWS_SECRET_ACCESS_KEY=args.aws_secret_access_key
+    if not args.region_id:
+        parser.error('--region_id is required')
+    if not args.volume_ids and not filters:
+        parser.error('Select volumes with --volume_ids, --from-file, --tag, --volume-type or --availability-zone')
 
-    migrateVol = MigrateVolume()
+    run_log = RunLog(args.run_id, args.run_dir)
+    logger.info("Run id %s, original volume attributes are saved to %s. Revert with --rollback %s", args.run_id, run_log.path, args.run_id)
+    migrators = {}
+    for region_id in args.region_id:
+        ec2_client = make_ec2_client(region_id, args.aws_access_key_id, args.aws_secret_access_key, args.profile, args.max_parallel)
+        migrators[region_id] = MigrateVolume(ec2_client, max_instance_iops=args.max_instance_iops, run_log=run_log)
 
     try:
-        migrateVol.modify_volumes_to_io2(args.volume_ids, args.iops_per_gb)
+        # Explicit ids are narrowed down by the selectors, if any
+        results = migrate_regions(migrators, args.volume_ids, filters, args.iops_per_gb, args.max_parallel)
     except Exception as err:
         logger.error("Failed to migrate volume. Error: %s", str(err))
         raise err
+    finally:
+        run_log.close()
+
+    if not results:
+        logger.warning("No volumes matched the selectors")
+    if not all(results.values()):
+        raise SystemExit(1)
@@ -1,92 +1,367 @@
 
 # Platform9 AWS CloudFormation Deployment Script for System Patch Manager & Amazon Inspector Classic
-# 
+#
 # Description:
 # This Python script performs the following tasks:
-# 1. Finds the default patch baseline for Ubuntu OS in an AWS region using AWS Systems Manager (SSM).
-# 2. Downloads a AWS CloudFormation template from Platform9 GitHub repository. 
-# 3. Deploys the CloudFormation template in an AWS region, using the found patch baseline as a parameter. 
-#    
+# 1. Finds the default patch baseline of every selected OS (--os-types, Ubuntu by default) in each AWS region
+#    using AWS Systems Manager (SSM), from one paginated describe_patch_baselines sweep.
+# 2. Downloads a AWS CloudFormation template from Platform9 GitHub repository, or revalidates the cached copy
+#    (~/.pf9/emp-scan-patch, keyed by template hash, ETag/If-None-Match), or uses --template-file.
+# 3. Deploys the CloudFormation template in every AWS region concurrently through a CloudFormation change set, using the
+#    found patch baselines as a parameter, and streams the stack events of all regions until every stack is done.
+#
 # Note:
 # An S3 bucket in same AWS region is required to upload the Cloudformation template as it is larger than 51200 bytes
+# When deploying to several regions, put "{region}" in the bucket name to use one bucket per region (e.g. pf9-cfn-{region})
+# The template is uploaded as pf9-emp-scan-patch/<sha256>.yaml and only if that object doesn't exist yet.
+# A region whose stack already runs the same template with the same parameters is skipped.
+# Updates only set SelectedPatchBaselines, the other stack parameters keep their current values.
 #
 # Usage:
 # python3 script_name.py --region <your_aws_region> --s3-bucket <your_s3_bucket>
-# 
-# Replace "script_name.py" with the actual name of your Python script, 
-# "your_aws_region" with the desired AWS region code (e.g., us-east-1, us-west-2), 
+# python3 script_name.py --regions us-east-1,us-west-2 --s3-bucket <your_s3_bucket>-{region}
+# python3 script_name.py --all-regions --s3-bucket <your_s3_bucket>-{region}
+# python3 script_name.py --region <your_aws_region> --s3-bucket <your_s3_bucket> --os-types UBUNTU,AMAZON_LINUX_2023,REDHAT_ENTERPRISE_LINUX
+#
+# Replace "script_name.py" with the actual name of your Python script,
+# "your_aws_region" with the desired AWS region code (e.g., us-east-1, us-west-2),
 # and "your_s3_bucket" with the name of the S3 bucket in "your_aws_region" to upload the CloudFormation template.
+# --all-regions deploys to every region enabled for the account.
 #
 # Note: Ensure that you have the necessary AWS credentials and permissions configured. Ensure S3 bucket is accessible.
 
 import boto3
-import subprocess
+import botocore
+import hashlib
 import os
 import json
 import sys
 import argparse
-
-parser = argparse.ArgumentParser()
-parser.add_argument('--region', required=True, help='AWS region')
-parser.add_argument('--s3-bucket', required=True, help='S3 bucket to store CloudFormation template')
-args = parser.parse_args()
+import concurrent.futures
+import threading
+import time
+import urllib.error
+import urllib.request
 
 # Define the GitHub repository URL and CloudFormation template path
 github_repo_url = 'https://raw.githubusercontent.com/platform9'
 template_path_on_github = 'support-locker/master/emp/emp_scan_patch_cftemplate.yml'
+template_cache_dir = os.path.expanduser('~/.pf9/emp-scan-patch')
 
-# Download the CloudFormation template from GitHub
-template_url = f"{github_repo_url}/{template_path_on_github}"
-template_path = 'pf9-cf-template.yaml'
-subprocess.check_call(['curl', '-o', template_path, '-L', template_url])
-
-# Define the Operating System
+# Define the default Operating System, override with --os-types
 # Supported Operating Systems: UBUNTU, CENTOS, WINDOWS, ROCKY_LINUX, DEBIAN, REDHAT_ENTERPRISE_LINUX, SUSE
 # ORACLE_LINUX, ALMA_LINUX, RASPBIAN, AMAZON_LINUX, AMAZON_LINUX_2, AMAZON_LINUX_2022, AMAZON_LINUX_2023
 os_type = 'UBUNTU'
 
-# Initialize the AWS SSM client
-ssm_client = boto3.client('ssm', region_name=args.region)
-
-try:
-    # Describe available patch baselines
-    response = ssm_client.describe_patch_baselines()
-
-    # Filter for the default Ubuntu patch baseline
-    for baseline in response['BaselineIdentities']:
-        if baseline.get('OperatingSystem') == os_type:
-            baseline_id = baseline.get('BaselineId')
-            baseline_name = baseline.get('BaselineName')
-            baseline_description = baseline.get('BaselineDescription')
-            data = {
-                os_type: {
-                    "value": baseline_id,
-                    "label": baseline_name,
-                    "description": baseline_description,
-                    "disabled": False
-                }
-            }
-            json_string = json.dumps(data)
-            PatchBaselines = json_string
+stack_name_prefix = 'pf9-emp-scan-patch-'
+change_set_poll_interval = 5
+stack_terminal_statuses = ('CREATE_COMPLETE', 'CREATE_FAILED', 'UPDATE_COMPLETE', 'UPDATE_FAILED', 'ROLLBACK_COMPLETE', 'ROLLBACK_FAILED',
+                           'UPDATE_ROLLBACK_COMPLETE', 'UPDATE_ROLLBACK_FAILED', 'DELETE_COMPLETE', 'DELETE_FAILED')
+# Returned by start_deploy when the stack has nothing to change
+up_to_date = object()
+
+
+print_lock = threading.Lock()
+
+
+def log(region, message):
+    # Regions deploy from several threads, keep each message whole
+    with print_lock:
+        print(f"[{region}] {message}", flush=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    regions = parser.add_mutually_exclusive_group(required=True)
+    regions.add_argument('--region', help='AWS region')
+    regions.add_argument('--regions', type=lambda value: [region for region in value.split(',') if region],
+                         help='Comma separated AWS regions, deployed concurrently')
+    regions.add_argument('--all-regions', action='store_true', help='Deploy to every AWS region enabled for the account')
+    parser.add_argument('--s3-bucket', required=True,
+                        help='S3 bucket to store CloudFormation template, "{region}" is replaced by the region')
+    parser.add_argument('--os-types', default=[os_type], type=lambda value: [os_name.strip().upper() for os_name in value.split(',') if os_name.strip()],
+                        help='Comma separated operating systems whose default patch baselines are selected, e.g. UBUNTU,AMAZON_LINUX_2023,REDHAT_ENTERPRISE_LINUX')
+    parser.add_argument('--template-file', help='Use this CloudFormation template instead of downloading it from GitHub')
+    return parser.parse_args()
+
+
+def resolve_regions(args):
+    if args.region:
+        return [args.region]
+    if args.regions:
+        return args.regions
+    # describe_regions only returns the regions enabled for the account
+    ec2_client = boto3.client('ec2', region_name=boto3.session.Session().region_name or 'us-east-1')
+    return sorted(region['RegionName'] for region in ec2_client.describe_regions()['Regions'])
+
+
+class Template:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.body = f.read()
+        self.sha256 = hashlib.sha256(self.body).hexdigest()
+        self.s3_key = f"{stack_name_prefix.rstrip('-')}/{self.sha256}.yaml"
+
+    def matches(self, body):
+        # get_template returns YAML templates as the original text
+        return isinstance(body, str) and hashlib.sha256(body.encode()).hexdigest() == self.sha256
+
+
+def download_template(cache_dir=template_cache_dir):
+    """
+    Returns the GitHub template from the local cache, stored by sha256. The
+    cached copy is revalidated with If-None-Match and still used if GitHub
+    can't be reached.
+    """
+    template_url = f"{github_repo_url}/{template_path_on_github}"
+    index_path = os.path.join(cache_dir, 'index.json')
+    os.makedirs(cache_dir, exist_ok=True)
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except (IOError, ValueError):
+        index = {}
+    cached = index.get(template_url)
+    if cached and not os.path.exists(os.path.join(cache_dir, cached['sha256'] + '.yaml')):
+        cached = None
+
+    request = urllib.request.Request(template_url)
+    if cached and cached.get('etag'):
+        request.add_header('If-None-Match', cached['etag'])
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            body = response.read()
+            etag = response.headers.get('ETag')
+    except urllib.error.HTTPError as e:
+        if e.code != 304:
+            raise
+        print(f"Template not modified since last download ({cached['sha256'][:12]})")
+        return Template(os.path.join(cache_dir, cached['sha256'] + '.yaml'))
+    except urllib.error.URLError as e:
+        if not cached:
+            raise
+        print(f"Could not reach {template_url} ({e.reason}), using cached template {cached['sha256'][:12]}")
+        return Template(os.path.join(cache_dir, cached['sha256'] + '.yaml'))
+
+    sha256 = hashlib.sha256(body).hexdigest()
+    path = os.path.join(cache_dir, sha256 + '.yaml')
+    if not os.path.exists(path):
+        with open(path + '.tmp', 'wb') as f:
+            f.write(body)
+        os.rename(path + '.tmp', path)
+    with open(index_path + '.tmp', 'w') as f:
+        index[template_url] = {'etag': etag, 'sha256': sha256}
+        json.dump(index, f)
+    os.rename(index_path + '.tmp', index_path)
+    print(f"Downloaded template {sha256[:12]} from {template_url}")
+    return Template(path)
+
+
+def find_patch_baselines(region, os_types):
+    """Returns the SelectedPatchBaselines stack parameter for every OS in os_types in the region."""
+    ssm_client = boto3.client('ssm', region_name=region)
+    baselines = {}
+    # One sweep over the AWS predefined baselines, the stack is deployed with PatchBaselineUseDefault=default
+    paginator = ssm_client.get_paginator('describe_patch_baselines')
+    for page in paginator.paginate(Filters=[{'Key': 'OWNER', 'Values': ['AWS']}]):
+        for baseline in page['BaselineIdentities']:
+            os_name = baseline.get('OperatingSystem')
+            # Prefer the baseline registered as the default for the OS
+            if os_name in os_types and (os_name not in baselines or baseline.get('DefaultBaseline') and not baselines[os_name].get('DefaultBaseline')):
+                baselines[os_name] = baseline
+    missing = [os_name for os_name in os_types if os_name not in baselines]
+    if missing:
+        raise ValueError(f"No default patch baseline found for {', '.join(missing)} in {region}")
+    data = {
+        os_name: {
+            "value": baselines[os_name].get('BaselineId'),
+            "label": baselines[os_name].get('BaselineName'),
+            "description": baselines[os_name].get('BaselineDescription'),
+            "disabled": False
+        }
+        for os_name in os_types
+    }
+    PatchBaselines = json.dumps(data)
+    log(region, f"Default patch baselines found for {', '.join(os_types)}\n{PatchBaselines}")
+    return PatchBaselines
+
+
+def describe_stack(cfn_client, cfn_stack_name):
+    try:
+        stack = cfn_client.describe_stacks(StackName=cfn_stack_name)['Stacks'][0]
+    except botocore.exceptions.ClientError as err:
+        if 'does not exist' in err.response['Error']['Message']:
+            return None
+        raise
+    return None if stack['StackStatus'] == 'DELETE_COMPLETE' else stack
+
+
+def stack_up_to_date(cfn_client, stack, template, parameters):
+    if stack['StackStatus'] not in ('CREATE_COMPLETE', 'UPDATE_COMPLETE'):
+        return False
+    current = {parameter['ParameterKey']: parameter.get('ParameterValue') for parameter in stack.get('Parameters', [])}
+    if any(current.get(parameter['ParameterKey']) != parameter['ParameterValue'] for parameter in parameters):
+        return False
+    return template.matches(cfn_client.get_template(StackName=stack['StackName'], TemplateStage='Original')['TemplateBody'])
+
+
+def upload_template(region, bucket, template):
+    s3_client = boto3.client('s3', region_name=region)
     try:
-        PatchBaselines
-        print(f"Default patch baseline found for {os_type} in selected AWS region\n{PatchBaselines}")
-    except NameError:
-        raise ValueError(f"No default patch baseline found for {os_type} in selected AWS region")
-    
-    # Create a variable for patch baseline key Value to pass as Cloudformation Stack Parameter    
-    parameter_key_value = 'SelectedPatchBaselines=%s' % PatchBaselines
+        # Objects are named after the template hash, an existing one has the same content
+        s3_client.head_object(Bucket=bucket, Key=template.s3_key)
+    except botocore.exceptions.ClientError as err:
+        if err.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+            raise
+        s3_client.upload_file(template.path, bucket, template.s3_key)
+    return f"https://{bucket}.s3.{region}.amazonaws.com/{template.s3_key}"
+
+
+def keep_previous_values(cfn_client, stack, template_url, parameters):
+    """
+    Returns parameters plus UsePreviousValue for every other parameter of the stack that the new template still
+    declares, like `aws cloudformation deploy`. An UPDATE otherwise resets them to their template defaults.
+    """
+    overridden = {parameter['ParameterKey'] for parameter in parameters}
+    declared = {parameter['ParameterKey'] for parameter in cfn_client.get_template_summary(TemplateURL=template_url)['Parameters']}
+    return parameters + [{'ParameterKey': parameter['ParameterKey'], 'UsePreviousValue': True}
+                         for parameter in stack.get('Parameters', [])
+                         if parameter['ParameterKey'] in declared and parameter['ParameterKey'] not in overridden]
+
+
+def create_change_set(cfn_client, stack_args, change_set_type):
+    """Creates the change set and waits until it is ready. Returns its name, or None if it has no changes."""
+    change_set_name = f"{stack_name_prefix}{int(time.time())}"
+    cfn_client.create_change_set(ChangeSetName=change_set_name, ChangeSetType=change_set_type, **stack_args)
+    while True:
+        change_set = cfn_client.describe_change_set(ChangeSetName=change_set_name, StackName=stack_args['StackName'])
+        if change_set['Status'] == 'CREATE_COMPLETE':
+            return change_set_name
+        if change_set['Status'] == 'FAILED':
+            reason = change_set.get('StatusReason', '')
+            if "didn't contain changes" in reason or 'No updates are to be performed' in reason:
+                cfn_client.delete_change_set(ChangeSetName=change_set_name, StackName=stack_args['StackName'])
+                return None
+            raise RuntimeError(f"Change set {change_set_name} failed: {reason}")
+        time.sleep(change_set_poll_interval)
+
+
+def latest_event_id(cfn_client, cfn_stack_name):
+    events = cfn_client.describe_stack_events(StackName=cfn_stack_name)['StackEvents']
+    return events[0]['EventId'] if events else None
+
+
+def new_stack_events(cfn_client, cfn_stack_name, cursor):
+    """Events after the cursor event id, oldest first. Pages are only fetched until the cursor is reached."""
+    events = []
+    paginator = cfn_client.get_paginator('describe_stack_events')
+    for page in paginator.paginate(StackName=cfn_stack_name):
+        for event in page['StackEvents']:
+            # Newest first
+            if event['EventId'] == cursor:
+                return events[::-1]
+            events.append(event)
+    return events[::-1]
+
+
+def start_deploy(region, bucket, template, os_types):
+    """
+    Uploads the template, then creates and executes a change set for the region's stack.
+    Returns the id of the last stack event before the execution, to stream from, or up_to_date.
+    """
+    PatchBaselines = find_patch_baselines(region, os_types)
+    parameters = [{'ParameterKey': 'SelectedPatchBaselines', 'ParameterValue': PatchBaselines}]
+
+    cfn_client = boto3.client('cloudformation', region_name=region)
+    cfn_stack_name = stack_name_prefix + region
+    stack = describe_stack(cfn_client, cfn_stack_name)
+    if stack is not None and stack_up_to_date(cfn_client, stack, template, parameters):
+        return up_to_date
+
+    # Upload the template, it is too large to be passed inline
+    template_url = upload_template(region, bucket, template)
+    # A stack left in REVIEW_IN_PROGRESS by an earlier CREATE change set was never created
+    create = stack is None or stack['StackStatus'] == 'REVIEW_IN_PROGRESS'
+    if not create:
+        # Keep the values operators set on the stack, e.g. RebootOption or the schedules
+        parameters = keep_previous_values(cfn_client, stack, template_url, parameters)
+    stack_args = dict(
+        StackName=cfn_stack_name,
+        TemplateURL=template_url,
+        Parameters=parameters,
+        Capabilities=['CAPABILITY_NAMED_IAM'],
+    )
+    log(region, f"{'Creating' if create else 'Updating'} stack '{cfn_stack_name}'")
+    change_set_name = create_change_set(cfn_client, stack_args, 'CREATE' if create else 'UPDATE')
+    if change_set_name is None:
+        return up_to_date
+    cursor = latest_event_id(cfn_client, cfn_stack_name)
+    cfn_client.execute_change_set(ChangeSetName=change_set_name, StackName=cfn_stack_name)
+    return cursor
+
+
+def stream_stack_events(region, cursor, poll_interval=5):
+    """Prints the stack events as they happen and returns the stack status once it is terminal."""
+    cfn_client = boto3.client('cloudformation', region_name=region)
+    cfn_stack_name = stack_name_prefix + region
+    while True:
+        for event in new_stack_events(cfn_client, cfn_stack_name, cursor):
+            cursor = event['EventId']
+            reason = f" ({event['ResourceStatusReason']})" if event.get('ResourceStatusReason') else ''
+            log(region, f"{event['Timestamp']:%H:%M:%S} {event['LogicalResourceId']} {event['ResourceStatus']}{reason}")
+            if event['LogicalResourceId'] == cfn_stack_name and event['ResourceStatus'] in stack_terminal_statuses:
+                return event['ResourceStatus']
+        time.sleep(poll_interval)
+
+
+def deploy_regions(regions, s3_bucket, template, os_types):
+    """Starts the deployment in every region, then streams the events of all the stacks together. Returns the failed regions."""
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(regions)) as executor:
+        started = {executor.submit(start_deploy, region, s3_bucket.format(region=region), template, os_types): region for region in regions}
+        streaming = {}
+        for future in concurrent.futures.as_completed(started):
+            region = started[future]
+            try:
+                cursor = future.result()
+            except Exception as e:
+                log(region, f"Error: {e}")
+                failed.append(region)
+                continue
+            if cursor is up_to_date:
+                log(region, f"Stack '{stack_name_prefix}{region}' is already up to date.")
+            else:
+                streaming[executor.submit(stream_stack_events, region, cursor)] = region
+
+        for future in concurrent.futures.as_completed(streaming):
+            region = streaming[future]
+            try:
+                status = future.result()
+            except Exception as e:
+                log(region, f"Error: {e}")
+                failed.append(region)
+                continue
+            if status in ('CREATE_COMPLETE', 'UPDATE_COMPLETE'):
+                log(region, f"Stack '{stack_name_prefix}{region}' has been deployed.")
+            else:
+                log(region, f"Error: stack '{stack_name_prefix}{region}' ended in {status}")
+                failed.append(region)
+    return failed
 
-    # Deploy the CloudFormation stack using the template and passing parameters
-    cfn_stack_name = 'pf9-emp-scan-patch-%s' % args.region
 
-    # Deploy the stack with parameters using the AWS CLI
-    subprocess.check_call(['aws', 'cloudformation', 'deploy', '--stack-name', cfn_stack_name, '--template-file', template_path, '--region', args.region, '--parameter-overrides', parameter_key_value, '--s3-bucket', args.s3_bucket, '--capabilities', 'CAPABILITY_NAMED_IAM'])
+if __name__ == '__main__':
+    args = parse_args()
+    regions = resolve_regions(args)
+    print(f"Deploying to regions: {', '.join(regions)}")
 
-    print(f"Stack '{cfn_stack_name}' has been deployed.")
+    if args.template_file:
+        template = Template(args.template_file)
+    else:
+        template = download_template()
 
-except Exception as e:
-    print(f"Error: {e}")
+    failed = deploy_regions(regions, args.s3_bucket, template, list(dict.fromkeys(args.os_types)))
 
-# Clean up: Delete the modified CloudFormation template
-os.remove(template_path)
\ No newline at end of file
+    if failed:
+        print(f"Deployment failed in regions: {', '.join(sorted(failed))}")
+        sys.exit(1)
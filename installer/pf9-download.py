@@ -3,7 +3,10 @@
 import getpass
 import json
 import optparse
+import os
+import socket
 import sys
+import threading
 
 if sys.version_info.major == 2:
     import httplib
@@ -13,8 +16,19 @@ elif sys.version_info.major == 3:
     from urllib import parse as urlparse
 
 
-def do_request(action, host, relative_url, headers, body, proxy=""):
-    if proxy != "":
+# Byte range fetched per request by parallel downloads, and read size
+RANGE_SIZE = 16 * 1024 * 1024
+READ_SIZE = 512 * 1024
+RANGE_RETRIES = 3
+# Bytes a single stream download writes between checkpoints
+CHECKPOINT_SIZE = 4 * 1024 * 1024
+
+
+def do_request(action, host, relative_url, headers, body, proxy="", conn=None):
+    # conn is a keep-alive connection to reuse, its previous response fully read
+    if conn is not None:
+       pass
+    elif proxy != "":
        proxyData = proxy.split(":")
        proxyHost = proxyData[0]
        proxyPort = proxyData[1]
@@ -38,7 +52,231 @@ def download_report(bytes_so_far, total_size, installer_name):
         sys.stdout.write('\n')
 
 
-def download_installer(url, token, cookie, installer_name, proxy=""):
+class DownloadProgress(object):
+    def __init__(self, total_size, installer_name, bytes_so_far=0):
+        self.total_size = total_size
+        self.installer_name = installer_name
+        self.bytes_so_far = bytes_so_far
+        self.lock = threading.Lock()
+
+    def add(self, nbytes):
+        with self.lock:
+            self.bytes_so_far += nbytes
+            download_report(self.bytes_so_far, self.total_size, self.installer_name)
+
+
+class Checkpoint(object):
+    """
+    Sidecar of a partial download, <installer>.part.json. Records the byte
+    ranges already on disk along with the validators of the file they came
+    from, so an interrupted download resumes instead of starting over.
+    """
+    def __init__(self, path, url, total_size, response):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = {
+            "url": url,
+            "size": total_size,
+            "etag": response.getheader('ETag'),
+            "last_modified": response.getheader('Last-Modified'),
+            "done": [],
+        }
+
+    def resume(self, partial_name):
+        # Keeps the ranges of a previous run only if it fetched the same file
+        if not (self.state["etag"] or self.state["last_modified"]):
+            return False
+        try:
+            with open(self.path) as checkpoint_file:
+                previous = json.load(checkpoint_file)
+            open(partial_name, 'rb').close()
+        except (IOError, OSError, ValueError):
+            return False
+        for key in ("url", "size", "etag", "last_modified"):
+            if previous.get(key) != self.state[key]:
+                return False
+        self.state["done"] = [list(done) for done in previous.get("done", [])]
+        return self.bytes_done() > 0
+
+    def bytes_done(self):
+        return sum(end + 1 - start for start, end in self.state["done"])
+
+    def offset(self):
+        # Length of the contiguous prefix, where a single stream resumes
+        done = self.state["done"]
+        return done[0][1] + 1 if done and done[0][0] == 0 else 0
+
+    def missing(self):
+        missing = []
+        position = 0
+        for start, end in self.state["done"] + [[self.state["size"], None]]:
+            if start > position:
+                missing.append((position, start - 1))
+            if end is not None:
+                position = end + 1
+        return missing
+
+    def add(self, start, end):
+        with self.lock:
+            merged = []
+            for done in sorted(self.state["done"] + [[start, end]]):
+                if merged and done[0] <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], done[1])
+                else:
+                    merged.append(list(done))
+            self.state["done"] = merged
+            self.save()
+
+    def reset(self):
+        with self.lock:
+            self.state["done"] = []
+            self.save()
+
+    def save(self):
+        # Written aside and renamed, an interruption never leaves half a file
+        checkpoint_file = open(self.path + '.tmp', 'w')
+        json.dump(self.state, checkpoint_file)
+        checkpoint_file.close()
+        os.rename(self.path + '.tmp', self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def fetch_range(host, path, headers, proxy, start, end, installer_file, progress, conn=None):
+    range_headers = dict(headers)
+    range_headers["Range"] = "bytes={0}-{1}".format(start, end)
+    conn, response = do_request("GET", host, path, range_headers, "", proxy, conn)
+    content_range = response.getheader('Content-Range') or ''
+    if response.status != 206 or not content_range.startswith("bytes {0}-".format(start)):
+        raise IOError("{0}: {1} for range {2}-{3}".format(
+            response.status, response.reason, start, end))
+
+    position = start
+    try:
+        while position <= end:
+            body = response.read(min(READ_SIZE, end + 1 - position))
+            if not body:
+                raise IOError("connection closed at byte {0}".format(position))
+            # Positional write, the file was preallocated to its full size
+            installer_file.seek(position)
+            installer_file.write(body)
+            position += len(body)
+            progress.add(len(body))
+    except Exception:
+        progress.add(start - position)
+        raise
+    # On disk before the checkpoint records the range
+    installer_file.flush()
+    os.fsync(installer_file.fileno())
+    return conn
+
+
+def range_worker(host, path, headers, proxy, ranges, partial_name, checkpoint, progress,
+                 errors, lock):
+    conn = None
+    # One file handle per worker so seek + write don't race
+    installer_file = open(partial_name, 'r+b')
+    try:
+        while True:
+            with lock:
+                if not ranges or errors:
+                    return
+                start, end = ranges.pop(0)
+            for attempt in range(RANGE_RETRIES):
+                try:
+                    conn = fetch_range(host, path, headers, proxy, start, end,
+                                       installer_file, progress, conn)
+                    checkpoint.add(start, end)
+                    break
+                except (IOError, socket.error, httplib.HTTPException) as e:
+                    if conn is not None:
+                        conn.close()
+                        conn = None
+                    if attempt == RANGE_RETRIES - 1:
+                        with lock:
+                            errors.append(e)
+                        return
+    finally:
+        installer_file.close()
+        if conn is not None:
+            conn.close()
+
+
+def download_ranges(host, path, headers, proxy, installer_name, partial_name, checkpoint,
+                    connections, resumed):
+    total_size = checkpoint.state["size"]
+    if not resumed:
+        # writes the file in the current working directory, preallocated
+        installer_file = open(partial_name, 'wb')
+        installer_file.truncate(total_size)
+        installer_file.close()
+        checkpoint.reset()
+
+    ranges = [(start, min(start + RANGE_SIZE - 1, end))
+              for first, end in checkpoint.missing()
+              for start in range(first, end + 1, RANGE_SIZE)]
+    progress = DownloadProgress(total_size, installer_name, checkpoint.bytes_done())
+    errors = []
+    lock = threading.Lock()
+    workers = [threading.Thread(target=range_worker,
+                                args=(host, path, headers, proxy, ranges, partial_name,
+                                      checkpoint, progress, errors, lock))
+               for _ in range(min(connections, len(ranges)))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    if errors:
+        print("\n{0}: download failed: {1}, run again to resume".format(
+            installer_name, errors[0]))
+        exit(1)
+
+
+def download_stream(response, installer_name, partial_name, checkpoint, offset):
+    total_size = checkpoint.state["size"]
+    bytes_read = offset
+
+    if offset:
+        installer_file = open(partial_name, 'r+b')
+        installer_file.seek(offset)
+    else:
+        # writes the file in the current working directory
+        installer_file = open(partial_name, 'wb')
+        checkpoint.reset()
+
+    try:
+        while True:
+            body = response.read(READ_SIZE)
+
+            if not body:
+                break
+
+            installer_file.write(body)
+            bytes_read += len(body)
+            download_report(bytes_read, total_size, installer_name)
+
+            if bytes_read // CHECKPOINT_SIZE != (bytes_read - len(body)) // CHECKPOINT_SIZE:
+                installer_file.flush()
+                os.fsync(installer_file.fileno())
+                checkpoint.add(0, bytes_read - 1)
+    except (KeyboardInterrupt, IOError, socket.error, httplib.HTTPException):
+        pass
+    finally:
+        installer_file.close()
+
+    if bytes_read < total_size:
+        if bytes_read:
+            checkpoint.add(0, bytes_read - 1)
+        print("\n{0}: download interrupted at {1} bytes, run again to resume".format(
+            installer_name, bytes_read))
+        exit(1)
+
+
+def download_installer(url, token, cookie, installer_name, proxy="", connections=1):
     headers = {"X-Auth-Token": token, "cookie": cookie}
     body = ""
 
@@ -50,23 +288,45 @@ def download_installer(url, token, cookie, installer_name, proxy=""):
         exit(1)
 
     total_size = int(response.getheader('Content-Length').strip())
-    bytes_read = 0
-
-    # writes the file in the current working directory
-    installer_file = open(installer_name, 'wb')
-
-    while True:
-        body = response.read(512 * 1024)
-        bytes_read += len(body)
-
-        if not body:
-            break
 
-        installer_file.write(body)
-        download_report(bytes_read, total_size, installer_name)
-
-    installer_file.close()
-    conn.close()
+    # Downloads go to <installer>.part, renamed once complete
+    partial_name = installer_name + '.part'
+    checkpoint = Checkpoint(partial_name + '.json', url, total_size, response)
+    accept_ranges = (response.getheader('Accept-Ranges') or '').strip().lower()
+    resumed = accept_ranges == 'bytes' and checkpoint.resume(partial_name)
+    if resumed:
+        print("{0}: resuming, {1} of {2} bytes already downloaded".format(
+            installer_name, checkpoint.bytes_done(), total_size))
+
+    if connections > 1 and accept_ranges == 'bytes' and total_size > RANGE_SIZE:
+        # Drop the single stream and fetch byte ranges over several connections
+        conn.close()
+        download_ranges(net_location, path, headers, proxy, installer_name,
+                        partial_name, checkpoint, connections, resumed)
+    else:
+        offset = checkpoint.offset() if resumed else 0
+        if 0 < offset < total_size:
+            conn.close()
+            resume_headers = dict(headers)
+            resume_headers["Range"] = "bytes={0}-".format(offset)
+            # The server sends the whole file instead if it changed meanwhile
+            resume_headers["If-Range"] = checkpoint.state["etag"] or \
+                checkpoint.state["last_modified"]
+            conn, response = do_request("GET", net_location, path, resume_headers,
+                                        body, proxy)
+            content_range = response.getheader('Content-Range') or ''
+            if response.status == 200:
+                offset = 0
+            elif response.status != 206 or \
+                    not content_range.startswith("bytes {0}-".format(offset)):
+                print("{0}: {1}".format(response.status, response.reason))
+                exit(1)
+        if offset < total_size:
+            download_stream(response, installer_name, partial_name, checkpoint, offset)
+        conn.close()
+
+    os.rename(partial_name, installer_name)
+    checkpoint.remove()
 
 
 def get_token_v3(host, username, password, tenant, proxy=""):
@@ -198,7 +458,8 @@ def get_installer(options):
         package_url = info['rpm_installer']
 
     installer_name = package_url.rsplit('/', 1)[1]
-    download_installer(package_url, 'token', info['cookie'], installer_name, options.proxy)
+    download_installer(package_url, 'token', info['cookie'], installer_name, options.proxy,
+                       options.connections)
 
 
 def validate_password(options):
@@ -210,7 +471,8 @@ def main():
     parser = optparse.OptionParser(
         usage="%prog --account_endpoint <endpoint> "
         "--region <region> --user <user> [--password <password>]"
-        " [--tenant <tenant>] --platform <redhat|debian> [--proxy <proxy>]")
+        " [--tenant <tenant>] --platform <redhat|debian> [--proxy <proxy>]"
+        " [--connections <n>]")
     parser.add_option(
         '--account_endpoint',
         dest="endpoint",
@@ -250,6 +512,14 @@ def main():
         dest="proxy",
         action="store",
         default="", help="Proxy to reach internet, in format <host>:<port>")
+    parser.add_option(
+        '--connections',
+        dest="connections",
+        action="store",
+        type='int',
+        default=4, help="Parallel connections used to download the installer "
+        "in byte ranges, when the server supports it. 1 downloads it as a "
+        "single stream")
 
     options, _ = parser.parse_args()
     if not (options.endpoint and options.region and
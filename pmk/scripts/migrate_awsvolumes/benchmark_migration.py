@@ -0,0 +1,185 @@
+"""
+Throughput benchmark for the EBS volume migration scripts, run against the
+offline EC2 stand-in in fake_ec2.py (no AWS account or credentials needed).
+
+It drives
+    - migrate_ebs_volume_gp2_to_gp3.py (discovery, rolling masters, worker pool)
+    - ../../../emp/migrate_to_io2.py (modify_volumes_to_io2)
+for simulated clusters of several sizes and reports, per run:
+    volumes/hour (simulated time), EC2 API calls per volume, throttled calls
+    and the peak number of live threads.
+
+python3 benchmark_migration.py
+python3 benchmark_migration.py --nodes 10,100,1000 --workerbatchsize 10 --wait-for optimizing --api-rate 20
+
+Note:
+    Simulated durations are scaled by `--time-scale` (default 0.001, i.e. a 5 minute
+    modification takes 0.3s), poll intervals of the scripts are scaled the same way.
+    requires boto3/botocore to be importable, like the scripts themselves
+"""
+
+import argparse
+import importlib.util
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+from fake_ec2 import FakeEC2
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+GP3_SCRIPT = os.path.join(HERE, "migrate_ebs_volume_gp2_to_gp3.py")
+IO2_SCRIPT = os.path.join(HERE, "..", "..", "..", "emp", "migrate_to_io2.py")
+
+logger = logging.getLogger('PF9')
+
+
+def load_script(path, name):
+    # Scripts import their sibling modules, as when run from their directory
+    directory = os.path.dirname(os.path.abspath(path))
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class ThreadSampler():
+    """Samples threading.active_count() in the background and keeps the peak."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, threading.active_count())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def scaled_backoff(script, time_scale):
+    return script.PollBackoff(min_interval=5 * time_scale,
+                              max_interval=300 * time_scale,
+                              throttle_base=2 * time_scale,
+                              throttle_cap=120 * time_scale)
+
+
+def make_ec2(args):
+    return FakeEC2(time_scale=args.time_scale, api_rate=args.api_rate,
+                   api_burst=args.api_burst)
+
+
+def bench_gp3(script, nodes, args, rng):
+    ec2 = make_ec2(args)
+    masters = ["i-master-{}".format(i) for i in range(min(3, nodes))]
+    workers = ["i-worker-{}".format(i) for i in range(nodes - len(masters))]
+    for instance_id in masters:
+        # Root and etcd volume on every master
+        ec2.add_volume(rng.choice(args.sizes), instance_id=instance_id)
+        ec2.add_volume(rng.choice(args.sizes), instance_id=instance_id)
+    for instance_id in workers:
+        ec2.add_volume(rng.choice(args.sizes), instance_id=instance_id)
+
+    # The limiter counts wall-clock seconds
+    rate = args.region_rate / args.time_scale if args.region_rate else None
+    region = script.Ec2Region(rate=rate, backoff=scaled_backoff(script, args.time_scale),
+                              ec2_client=ec2)
+    migratevol = script.MigrateVolume(None, args.wait_for, region)
+    start = time.time()
+    with ThreadSampler() as sampler:
+        migratevol.discover_volumes(masters + workers)
+        migratevol.migrate_masters(masters)
+        results = migratevol.batch_migrate_volumes(workers, args.workerbatchsize)
+        migratevol.wait_for_background()
+    failed = [instance_id for instance_id, err in results.items() if err is not None]
+    return ec2, time.time() - start, sampler.peak, len(failed)
+
+
+def bench_io2(script, nodes, args, rng):
+    ec2 = make_ec2(args)
+    volume_ids = [ec2.add_volume(rng.choice(args.sizes), volume_type="gp3")
+                  for _ in range(nodes)]
+
+    migratevol = script.MigrateVolume(ec2, scaled_backoff(script, args.time_scale))
+    start = time.time()
+    with ThreadSampler() as sampler:
+        migratevol.modify_volumes_to_io2(volume_ids, args.iops_per_gb, args.max_parallel)
+    failed = [v for v in volume_ids if ec2.volumes[v]["VolumeType"] != "io2"]
+    return ec2, time.time() - start, sampler.peak, len(failed)
+
+
+BENCHMARKS = {
+    "gp3": (GP3_SCRIPT, bench_gp3),
+    "io2": (IO2_SCRIPT, bench_io2),
+}
+
+
+def run(args):
+    print("{:<5} {:>6} {:>8} {:>12} {:>12} {:>10} {:>10} {:>8} {:>7}".format(
+        "tool", "nodes", "volumes", "sim-time", "volumes/h", "calls/vol",
+        "throttled", "threads", "failed"))
+    for tool in args.tools:
+        path, bench = BENCHMARKS[tool]
+        script = load_script(path, "bench_" + tool)
+        if not args.verbose:
+            logger.setLevel(logging.WARNING)
+        for nodes in args.nodes:
+            rng = random.Random(args.seed)
+            ec2, wall, peak, failed = bench(script, nodes, args, rng)
+            volumes = len(ec2.modifications)
+            sim_seconds = wall / args.time_scale
+            print("{:<5} {:>6} {:>8} {:>11.0f}s {:>12.1f} {:>10.2f} {:>10} {:>8} {:>7}".format(
+                tool, nodes, volumes, sim_seconds,
+                volumes / sim_seconds * 3600 if sim_seconds else 0,
+                sum(ec2.calls.values()) / float(max(volumes, 1)),
+                ec2.throttles, peak, failed))
+
+
+def int_list(value):
+    return [int(item) for item in value.split(",") if item]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark the EBS migration scripts against a simulated EC2")
+    parser.add_argument('--tools', default="gp3,io2",
+                        type=lambda value: [tool for tool in value.split(",") if tool],
+                        help="Comma separated scripts to run: gp3, io2")
+    parser.add_argument('--nodes', default="10,100,1000", type=int_list,
+                        help="Comma separated simulated cluster sizes")
+    parser.add_argument('--sizes', default="20,50,100", type=int_list,
+                        help="Volume sizes in GiB to pick from")
+    parser.add_argument('--workerbatchsize', default=5, type=int)
+    parser.add_argument('--wait-for', default="completed",
+                        choices=["modifying", "optimizing", "completed"])
+    parser.add_argument('--iops_per_gb', default=50, type=int)
+    parser.add_argument('--max-parallel', default=10, type=int,
+                        help="io2 conversions in flight")
+    parser.add_argument('--time-scale', default=0.001, type=float,
+                        help="Wall-clock seconds per simulated second")
+    parser.add_argument('--api-rate', default=100, type=float,
+                        help="Simulated EC2 API calls per second before throttling")
+    parser.add_argument('--api-burst', default=200, type=float)
+    parser.add_argument('--region-rate', default=0, type=float,
+                        help="gp3 script --region-rate, in simulated calls per second (0: off)")
+    parser.add_argument('--seed', default=1, type=int)
+    parser.add_argument('--verbose', action='store_true',
+                        help="Keep the scripts' INFO logging")
+    args = parser.parse_args()
+    for tool in args.tools:
+        if tool not in BENCHMARKS:
+            parser.error("unknown tool {}".format(tool))
+    run(args)
@@ -0,0 +1,310 @@
+"""
+Offline stand-in for the boto3 EC2 client, used by benchmark_migration.py to
+drive migrate_ebs_volume_gp2_to_gp3.py and emp/migrate_to_io2.py without AWS.
+
+Only the calls the migration scripts make are modelled: describe_volumes,
+modify_volume, describe_volumes_modifications (plus their paginators).
+Volumes can't be modified again within COOLDOWN_SECONDS of the previous
+modification, as on EC2. A
+modification spends a size-dependent time in "modifying", then in
+"optimizing", then completes. Calls beyond the configured API rate are
+throttled with RequestLimitExceeded; like botocore's default (legacy) retry
+mode the client retries those a few times with exponential backoff before
+raising. Handlers registered on the before-call, request-created and
+needs-retry events are called like botocore does, once per attempt for the
+last two.
+
+All durations are given in simulated seconds and multiplied by time_scale, so
+a 5 minute modification takes 0.3s of wall-clock time with time_scale=0.001.
+"""
+
+import collections
+import datetime
+import itertools
+import random
+import threading
+import time
+import types
+
+import botocore.exceptions
+
+
+def client_error(code, message, operation):
+    return botocore.exceptions.ClientError(
+        {"Error": {"Code": code, "Message": message}}, operation)
+
+
+class FakePaginator():
+    def __init__(self, client, operation, result_key, page_size):
+        self.client = client
+        self.operation = operation
+        self.result_key = result_key
+        self.page_size = page_size
+
+    def paginate(self, **kwargs):
+        token = None
+        while True:
+            page = getattr(self.client, self.operation)(
+                MaxResults=self.page_size, NextToken=token, **kwargs)
+            yield page
+            token = page.get("NextToken")
+            if not token:
+                return
+
+
+class FakeEC2():
+    """
+    Thread-safe in-memory EC2 volume service.
+
+    modifying_seconds/optimizing_seconds are (base, per GiB) pairs in
+    simulated seconds. api_rate is the sustained calls per simulated second
+    allowed before RequestLimitExceeded, api_burst the bucket size.
+    """
+    PAGE_SIZE = 500
+    COOLDOWN_SECONDS = 6 * 3600
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, time_scale=0.001, modifying_seconds=(10, 0.1),
+                 optimizing_seconds=(60, 2.0), api_rate=100, api_burst=200,
+                 region="us-fake-1"):
+        self.time_scale = time_scale
+        self.modifying_seconds = modifying_seconds
+        self.optimizing_seconds = optimizing_seconds
+        self.api_rate = api_rate
+        self.api_burst = api_burst
+        self.volumes = collections.OrderedDict()
+        self.modifications = {}
+        self.calls = collections.Counter()
+        self.throttles = 0
+        self._tokens = api_burst
+        self._last_refill = time.time()
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._hooks = []
+        self.meta = types.SimpleNamespace(
+            region_name=region,
+            events=types.SimpleNamespace(register=self._register))
+
+    def _register(self, event_name, handler, **kwargs):
+        self._hooks.append((event_name, handler))
+
+    def _emit(self, event_name, **kwargs):
+        # Like botocore's emit_until_response: the first non-None return wins
+        for name, handler in self._hooks:
+            if event_name == name or event_name.startswith(name + "."):
+                response = handler(event_name=event_name, **kwargs)
+                if response is not None:
+                    return response
+        return None
+
+    def add_volume(self, size, volume_type="gp2", instance_id=None,
+                   availability_zone="us-fake-1a", tags=None, iops=None):
+        volume_id = "vol-{:017x}".format(next(self._ids))
+        volume = {
+            "VolumeId": volume_id,
+            "VolumeType": volume_type,
+            "Size": size,
+            "AvailabilityZone": availability_zone,
+            "State": "in-use" if instance_id else "available",
+            "Iops": iops if iops is not None else max(100, min(16000, size * 3)),
+            "MultiAttachEnabled": False,
+            "Attachments": [],
+            "Tags": [{"Key": key, "Value": value}
+                     for key, value in (tags or {}).items()],
+        }
+        if instance_id:
+            volume["Attachments"].append({
+                "InstanceId": instance_id, "VolumeId": volume_id,
+                "State": "attached", "Device": "/dev/xvda"})
+        with self._lock:
+            self.volumes[volume_id] = volume
+        return volume_id
+
+    def _call(self, operation):
+        context = {}
+        response = self._emit("before-call.ec2." + operation)
+        if response is not None:
+            # botocore returns a before-call response instead of sending the request
+            http, parsed = response
+            return parsed
+        for attempt in range(self.MAX_ATTEMPTS):
+            context["retries"] = {"attempt": attempt + 1}
+            self._emit("request-created.ec2." + operation,
+                       request=types.SimpleNamespace(context=context),
+                       operation_name=operation)
+            with self._lock:
+                self.calls[operation] += 1
+                now = time.time()
+                refill = (now - self._last_refill) / self.time_scale * self.api_rate
+                self._tokens = min(self.api_burst, self._tokens + refill)
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                self.throttles += 1
+            self._emit("needs-retry.ec2." + operation,
+                       response=(None, {"Error": {"Code": "RequestLimitExceeded"}}),
+                       request_dict={"context": context})
+            time.sleep(random.random() * 2 ** attempt * self.time_scale)
+        raise client_error("RequestLimitExceeded", "Request limit exceeded.",
+                           operation)
+
+    @staticmethod
+    def _page(items, max_results, next_token):
+        start = int(next_token or 0)
+        end = start + (max_results or len(items) or 1)
+        return items[start:end], (str(end) if end < len(items) else None)
+
+    @staticmethod
+    def _matches(volume, filters):
+        for filter in filters or []:
+            name, values = filter["Name"], filter["Values"]
+            if name == "attachment.instance-id":
+                found = [a["InstanceId"] for a in volume["Attachments"]]
+            elif name == "volume-type":
+                found = [volume["VolumeType"]]
+            elif name == "availability-zone":
+                found = [volume["AvailabilityZone"]]
+            elif name == "volume-id":
+                found = [volume["VolumeId"]]
+            elif name == "status":
+                found = [volume["State"]]
+            elif name.startswith("tag:"):
+                found = [tag["Value"] for tag in volume["Tags"]
+                         if tag["Key"] == name[len("tag:"):]]
+            else:
+                raise client_error("InvalidParameterValue",
+                                   "Unsupported filter {}".format(name),
+                                   "DescribeVolumes")
+            if not set(found) & set(values):
+                return False
+        return True
+
+    def describe_volumes(self, VolumeIds=None, Filters=None, MaxResults=None,
+                         NextToken=None):
+        short_circuit = self._call("DescribeVolumes")
+        if short_circuit is not None:
+            return short_circuit
+        with self._lock:
+            if VolumeIds:
+                missing = [v for v in VolumeIds if v not in self.volumes]
+                if missing:
+                    raise client_error(
+                        "InvalidVolume.NotFound",
+                        "The volume '{}' does not exist.".format(",".join(missing)),
+                        "DescribeVolumes")
+                volumes = [self.volumes[v] for v in VolumeIds]
+            else:
+                volumes = list(self.volumes.values())
+            volumes = [dict(v) for v in volumes if self._matches(v, Filters)]
+        page, token = self._page(volumes, MaxResults, NextToken)
+        response = {"Volumes": page}
+        if token:
+            response["NextToken"] = token
+        return response
+
+    def modify_volume(self, VolumeId, VolumeType=None, Iops=None, Throughput=None,
+                      MultiAttachEnabled=None, Size=None):
+        short_circuit = self._call("ModifyVolume")
+        if short_circuit is not None:
+            return short_circuit
+        now = time.time()
+        with self._lock:
+            if VolumeId not in self.volumes:
+                raise client_error("InvalidVolume.NotFound",
+                                   "The volume '{}' does not exist.".format(VolumeId),
+                                   "ModifyVolume")
+            volume = self.volumes[VolumeId]
+            previous = self.modifications.get(VolumeId)
+            if previous is not None and \
+                    now - previous["_start"] < self.COOLDOWN_SECONDS * self.time_scale:
+                raise client_error(
+                    "VolumeModificationRateExceeded",
+                    "You've reached the maximum modification rate per volume limit.",
+                    "ModifyVolume")
+            if MultiAttachEnabled and any(a["State"] == "attached"
+                                          for a in volume["Attachments"]):
+                raise client_error(
+                    "InvalidParameterCombination",
+                    "Multi-Attach cannot be enabled on an attached volume.",
+                    "ModifyVolume")
+            size = volume["Size"]
+            modifying = (self.modifying_seconds[0] + size * self.modifying_seconds[1])
+            optimizing = (self.optimizing_seconds[0] + size * self.optimizing_seconds[1])
+            modification = {
+                "VolumeId": VolumeId,
+                "ModificationState": "modifying",
+                "OriginalVolumeType": volume["VolumeType"],
+                "TargetVolumeType": VolumeType or volume["VolumeType"],
+                "OriginalIops": volume.get("Iops"),
+                "TargetIops": Iops or volume.get("Iops"),
+                "Progress": 0,
+                "StartTime": datetime.datetime.now(datetime.timezone.utc),
+                "_start": now,
+                "_modifying": modifying * self.time_scale,
+                "_total": (modifying + optimizing) * self.time_scale,
+            }
+            self.modifications[VolumeId] = modification
+            volume["VolumeType"] = modification["TargetVolumeType"]
+            volume["Iops"] = modification["TargetIops"]
+            if Throughput is not None:
+                volume["Throughput"] = Throughput
+            if MultiAttachEnabled is not None:
+                volume["MultiAttachEnabled"] = MultiAttachEnabled
+        return {"VolumeModification": self._public(modification)}
+
+    def _advance(self, modification):
+        elapsed = time.time() - modification["_start"]
+        if elapsed >= modification["_total"]:
+            if modification["ModificationState"] != "completed":
+                modification["ModificationState"] = "completed"
+                modification["EndTime"] = modification["StartTime"] + \
+                    datetime.timedelta(seconds=modification["_total"])
+            modification["Progress"] = 100
+        else:
+            modification["ModificationState"] = "modifying" \
+                if elapsed < modification["_modifying"] else "optimizing"
+            modification["Progress"] = int(100 * elapsed / modification["_total"])
+
+    @staticmethod
+    def _public(modification):
+        return {key: value for key, value in modification.items()
+                if not key.startswith("_")}
+
+    def describe_volumes_modifications(self, VolumeIds=None, Filters=None,
+                                       MaxResults=None, NextToken=None):
+        short_circuit = self._call("DescribeVolumesModifications")
+        if short_circuit is not None:
+            return short_circuit
+        with self._lock:
+            volume_ids = VolumeIds or list(self.modifications)
+            for filter in Filters or []:
+                if filter["Name"] != "volume-id":
+                    raise client_error("InvalidParameterValue",
+                                       "Unsupported filter {}".format(filter["Name"]),
+                                       "DescribeVolumesModifications")
+                # Unlike VolumeIds, filtering skips volumes never modified
+                volume_ids = [v for v in volume_ids
+                              if v in filter["Values"] and v in self.modifications]
+            missing = [v for v in volume_ids if v not in self.modifications]
+            if missing:
+                raise client_error(
+                    "InvalidVolumeModification.NotFound",
+                    "Modification for volume '{}' does not exist.".format(missing[0]),
+                    "DescribeVolumesModifications")
+            modifications = []
+            for volume_id in volume_ids:
+                self._advance(self.modifications[volume_id])
+                modifications.append(self._public(self.modifications[volume_id]))
+        page, token = self._page(modifications, MaxResults, NextToken)
+        response = {"VolumesModifications": page}
+        if token:
+            response["NextToken"] = token
+        return response
+
+    def get_paginator(self, operation):
+        result_keys = {
+            "describe_volumes": "Volumes",
+            "describe_volumes_modifications": "VolumesModifications",
+        }
+        return FakePaginator(self, operation, result_keys[operation], self.PAGE_SIZE)
@@ -10,27 +10,91 @@ pre-req:
 python3 migrate_ebs_volume_gp2_to_gp3.py --kdu="XXXX.platform9.horse" --tenant=test --username="XXXX@platform9.com" --password="XXXXXX" --cluster_id 6d99076d-8137-444a-bcaf-e165f873a9f7
 
 optional argument:
+    `cluster_id` also accepts several UUIDs, globs on cluster UUID/name (quote them) or `all`
+    for every AWS cluster in the tenant. Clusters are grouped by region, each region gets its own
+    EC2 client (see `--region-rate`) and up to `--parallel-clusters` clusters migrate at once
+    ex: python3 migrate_ebs_volume_gp2_to_gp3.py ... --cluster_id all --parallel-clusters 8 --region-rate 20
+
     `workerbatchsize` by default set to 5 workers at a time
     ex: python3 migrate_ebs_volume_gp2_to_gp3.py --kdu="XXXX.platform9.horse" --tenant=test --username="XXXX@platform9.com" --password="XXXXXX" --cluster_id 6d99076d-8137-444a-bcaf-e165f873a9f7 --workerbatchsize 10
 
 Note:
-    Volume migration for master nodes are done sequentially
-    for worker node we can have a batch of size 5 to migrate parallelly
+    Volume migration for master nodes is rolling: one master at a time (keeps etcd quorum), all
+    volumes of that master are modified concurrently and the next master starts once they reach
+    the `--master-wait-for` state (completed by default, at least optimizing, independent of
+    `--wait-for`)
+    for worker nodes up to `workerbatchsize` (default 5) nodes are migrated in parallel,
+    the next node starts as soon as any in-flight node finishes
+
+    Timetaken to migrate a volume is around ~5mins, most of it in the "optimizing" state.
+    A volume is usable as gp3 once it is "optimizing", so `--wait-for optimizing` frees the
+    node's slot at that point; the script still waits for all volumes to complete before exiting.
+
+    Progress is journaled to gp3-migration-<cluster_id>.jsonl (see `--journal-dir`).
+    If a run is interrupted, rerun the same command with `--resume` to skip
+    finished instances/volumes and go straight to polling in-flight volumes.
+
+    `--plan` only discovers volumes and prints how many gp2 volumes/GiB would be migrated, the
+    volumes that would be skipped and the estimated wall-clock time for several workerbatchsize
+    values, based on per-GiB durations journaled by earlier runs in `--journal-dir`.
+
+    gp3 volumes get 3000 IOPS / 125 MiB/s by default. `--size-gp3` reads each volume's I/O history
+    (CloudWatch AWS/EBS VolumeRead/WriteOps and Bytes over `--size-days`, batched GetMetricData calls)
+    and sets IOPS/throughput to the peak times `--size-headroom`, never below the gp2 baseline of
+    3 IOPS/GiB. `--size-metrics-file metrics.json` reads the same history from a local file instead
+    (see Gp3Sizer for the format). The chosen values are logged, also with `--plan`.
+
+    Each run has an id (`--run-id`, the start time by default) and saves the type/IOPS/throughput
+    of every volume it modifies, as discovered, to gp3-run-<run-id>.jsonl in `--journal-dir`.
+    `--rollback <run-id>` reverts the volumes of the selected clusters changed by that run, up to
+    `--rollback-parallel` volumes at a time. EC2 allows one modification per volume every 6 hours,
+    so volumes modified more recently are queued until they become eligible (see ebs-common/ebs_common.py).
 
-    Timetaken to migrate a volume is around ~5mins
+    Keystone tokens are cached per DU and user in ~/.pf9/token-cache.json (mode 0600) and reused
+    until shortly before they expire, or until keystone rejects them (the entry is then dropped
+    and the request retried with a new token); pass `--no-token-cache` to always authenticate.
+
+    `--metrics-file report.json|report.csv` records EC2 API latency/errors/retries/throttles per
+    operation, queue wait per node and time spent modifying/optimizing per volume;
+    `--prometheus-file` writes the same data for the node_exporter textfile collector.
 
 """
 
 import argparse
+import calendar
+import codecs
+import csv
+import hashlib
 import json
 import logging
+import os
+import sys
 import boto3
+import datetime
+import fnmatch
+import glob
+import heapq
+import math
 import time
 import botocore
+import concurrent.futures
 from pprint import pprint
 
 import requests
 import threading
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Shared with emp/migrate_to_io2.py, found next to this script or in the repository's ebs-common/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "..", "..", "ebs-common"))
+try:
+    from ebs_common import (ModificationPoller, PollBackoff, RunLog, THROTTLE_CODES,
+                            VolumeRollback)
+except ImportError as err:
+    if err.name != "ebs_common":
+        raise
+    sys.exit("ebs_common.py not found, copy ebs-common/ebs_common.py next to this script")
 
 requests.urllib3.disable_warnings()
 
@@ -42,75 +106,242 @@ logging.basicConfig(
 logger = logging.getLogger('PF9')
 
 
+_session = None
+_session_lock = threading.Lock()
+
+
+def http_session(pool_size=20, retries=3):
+    """
+    Shared keep-alive session for every DU call, so connections (and TLS
+    handshakes) are reused across keystone and qbert requests.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=retries, backoff_factor=0.5,
+                          status_forcelist=(500, 502, 503, 504))
+            adapter = HTTPAdapter(pool_connections=pool_size,
+                                  pool_maxsize=pool_size, max_retries=retry)
+            _session = requests.Session()
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+            _session.verify = False
+        return _session
+
+
+class RestClientError(Exception):
+    def __init__(self, message, status_code):
+        super(RestClientError, self).__init__(message)
+        self.status_code = status_code
+
+
+def iter_json_array(response, chunk_size=64 * 1024):
+    """
+    Yield the elements of a top-level JSON array from a streamed response
+    without holding the whole document in memory.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")()
+    buf, pos, started, done = "", 0, False, False
+    chunks = response.iter_content(chunk_size=chunk_size)
+    while not done:
+        chunk = next(chunks, None)
+        done = chunk is None
+        buf = buf[pos:] + text_decoder.decode(chunk or b"", final=done)
+        pos = 0
+        while True:
+            while pos < len(buf) and (buf[pos].isspace() or buf[pos] == ","):
+                pos += 1
+            if pos == len(buf):
+                break
+            if not started:
+                if buf[pos] != "[":
+                    raise ValueError("Expected a JSON array")
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # Element continues in the next chunk
+                break
+            if not done and not isinstance(item, (dict, list)) and \
+                    (end == len(buf) or buf[end] not in " \t\r\n,]"):
+                # A number cut by the chunk boundary continues in the next one
+                break
+            pos = end
+            yield item
+    raise ValueError("Truncated or invalid JSON array in response")
+
+
 class RestClient(object):
-    METHODS = {
-        "get": requests.get,
-        "put": requests.put,
-    }
+    METHODS = ("get", "put")
 
-    def __init__(self, token, api_version=4):
+    def __init__(self, token, api_version=4, session=None):
         self.token = token
-        self._headers = {
-            "X-Auth-Token": self.token.token
-        }
+        self.session = session or http_session()
         self._base_url = "https://{}/qbert/v{}/{}/".format(
             self.token.kdu, api_version, self.token.project_id)
 
-    def _make_request(self, method_type, url):
+    def _make_request(self, method_type, url, stream=False):
         logger.debug("%s %s", method_type.upper(), url)
-        method = self.METHODS[method_type]
+        if method_type not in self.METHODS:
+            raise ValueError("Unsupported method {}".format(method_type))
+        method = getattr(self.session, method_type)
         url = self._build_url(url)
-        args = {
-            "url": url,
-            "headers": self._headers,
-            "verify": False
-        }
-        try:
-            response = method(**args)
-        except Exception as err:
-            raise err
+        for attempt in range(2):
+            # Read the token per request so a refreshed token is picked up
+            token = self.token.token
+            args = {
+                "url": url,
+                "headers": {"X-Auth-Token": token},
+                "verify": False,
+                "stream": stream
+            }
+            try:
+                response = method(**args)
+            except Exception as err:
+                raise err
+            if response.status_code != 401 or attempt:
+                break
+            # Token revoked before its expiry (password change, logout...)
+            self.token.refresh(token)
         if 200 <= response.status_code < 400:
             return response
         message = "Request:{}, fail with statuscode:{}. URL:{} Reason:{}".format(
             response.request, response.status_code, response.url, response.reason)
-        raise Exception(message)
+        raise RestClientError(message, response.status_code)
 
     def _build_url(self, part_url):
         if part_url.startswith("/"):
             part_url = part_url.lstrip("/")
         return self._base_url + part_url
 
-    def get(self, url):
-        return self._make_request("get", url)
+    def get(self, url, stream=False):
+        return self._make_request("get", url, stream)
 
     def put(self, url):
         return self._make_request("put", url)
 
 
+class TokenCache():
+    """
+    On-disk keystone token cache keyed by DU and username (never the
+    password), so repeated runs skip keystone authentication.
+    """
+
+    def __init__(self, path=os.path.expanduser("~/.pf9/token-cache.json")):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(kdu, username):
+        return hashlib.sha256("{}|{}".format(kdu, username).encode()).hexdigest()
+
+    def _read(self):
+        try:
+            with open(self.path) as cache:
+                return json.load(cache)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get(self, kdu, username):
+        with self._lock:
+            return self._read().get(self.key(kdu, username))
+
+    def put(self, kdu, username, entry):
+        with self._lock:
+            entries = self._read()
+            # Drop expired tokens of other DUs/users while rewriting the file
+            entries = {key: value for key, value in entries.items()
+                       if value.get("expires_at", 0) > time.time()}
+            entries[self.key(kdu, username)] = entry
+            self._write(entries)
+
+    def remove(self, kdu, username):
+        with self._lock:
+            entries = self._read()
+            if entries.pop(self.key(kdu, username), None) is not None:
+                self._write(entries)
+
+    def _write(self, entries):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        tmp_path = self.path + ".tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as cache:
+            json.dump(entries, cache)
+        os.rename(tmp_path, self.path)
+
+
+def parse_keystone_time(value):
+    for fmt in ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"):
+        try:
+            return calendar.timegm(datetime.datetime.strptime(value, fmt).timetuple())
+        except ValueError:
+            continue
+    raise ValueError("Unrecognized keystone time {}".format(value))
+
+
 class Token():
+    # Refresh this many seconds before keystone's expires_at
+    REFRESH_MARGIN = 600
 
-    def __init__(self, kdu, projectname, username, password):
+    def __init__(self, kdu, projectname, username, password, session=None,
+                 cache=None):
         self._kdu = kdu
         self._projectname = projectname
         self._username = username
         self._password = password
+        self._session = session or http_session()
+        self._cache = cache
         self._headers = {"Content-Type": "application/json"}
         self._base_url = "https://{}/".format(
             self._kdu)
         self._token = None
-        self._get_token()
+        self._expires_at = None
         self._project_id = None
-        self._get_projectid()
+        self._lock = threading.Lock()
+        cached = self._load_cached()
+        if not cached:
+            self._get_token()
+        if self._project_id is None:
+            try:
+                self._get_projectid()
+            except requests.HTTPError as err:
+                if not cached or err.response.status_code != 401:
+                    raise
+                self.refresh(self._token)
+                self._get_projectid()
+        self._save_cached()
 
     @property
     def token(self):
-        # If token gets expire in 24 hrs
-        # time_diff = (datetime.datetime.now() -
-        #              self.fetch_time).total_seconds()
-        # if time_diff > 86000:
-        #     logger.info("Token has expired. Fetching new token...")
-        #     self._get_token()
-        return self._token
+        with self._lock:
+            if self._expires_at is not None and \
+                    time.time() > self._expires_at - self.REFRESH_MARGIN:
+                logger.info("Token is about to expire. Fetching new token...")
+                self._get_token()
+                self._save_cached()
+            return self._token
+
+    def refresh(self, rejected_token):
+        """
+        Re-authenticate after keystone rejected rejected_token, unless another
+        thread already replaced it. The cached entry is dropped first so a
+        failing authentication doesn't leave the revoked token behind.
+        """
+        with self._lock:
+            if self._token != rejected_token:
+                return
+            logger.info("Token was rejected by keystone. Fetching new token...")
+            if self._cache is not None:
+                self._cache.remove(self._kdu, self._username)
+            self._get_token()
+            self._save_cached()
 
     @property
     def kdu(self):
@@ -120,6 +351,31 @@ class Token():
     def project_id(self):
         return self._project_id
 
+    def _load_cached(self):
+        if self._cache is None:
+            return False
+        entry = self._cache.get(self._kdu, self._username)
+        if not entry or time.time() > entry["expires_at"] - self.REFRESH_MARGIN:
+            return False
+        self._token = entry["token"]
+        self._expires_at = entry["expires_at"]
+        self._project_id = entry.get("projects", {}).get(self._projectname)
+        logger.debug("Using cached token for %s", self._kdu)
+        return True
+
+    def _save_cached(self):
+        if self._cache is None or self._expires_at is None:
+            return
+        entry = self._cache.get(self._kdu, self._username) or {}
+        projects = entry.get("projects", {}) if entry.get("token") == self._token else {}
+        if self._project_id is not None:
+            projects[self._projectname] = self._project_id
+        self._cache.put(self._kdu, self._username, {
+            "token": self._token,
+            "expires_at": self._expires_at,
+            "projects": projects,
+        })
+
     def _get_token(self):
         keystone_url = self._base_url + "keystone/v3/auth/tokens"
         payload = json.dumps({
@@ -142,22 +398,23 @@ class Token():
         })
 
         headers = self._headers.copy()
-        #self.fetch_time = datetime.datetime.now()
-        response = requests.post(keystone_url, headers=headers,
-                                 data=payload, verify=False, timeout=60)
+        response = self._session.post(keystone_url, headers=headers,
+                                      data=payload, timeout=60)
 
         if response.status_code == 201:
             self._token = response.headers["X-Subject-Token"]
+            expires_at = response.json().get("token", {}).get("expires_at")
+            self._expires_at = parse_keystone_time(expires_at) if expires_at else None
         response.raise_for_status()
 
     def _get_projectid(self):
         project_url = self._base_url + "keystone/v3/projects"
         headers = self._headers.copy()
         headers.update({
-            "X-Auth-Token": self.token
+            "X-Auth-Token": self._token
         })
-        response = requests.get(project_url, headers=headers,
-                                verify=False, timeout=60)
+        response = self._session.get(project_url, headers=headers,
+                                     timeout=60)
 
         if response.status_code == 200:
             projects = response.json()["projects"]
@@ -169,137 +426,1241 @@ class Token():
 
 
 class QbertAPI():
-    def __init__(self, kdu, tenant, username, password):
+    def __init__(self, kdu, tenant, username, password, token_cache=None):
         self.token = Token(kdu, tenant, username,
-                           password)
+                           password, cache=token_cache)
         self.restClient = RestClient(self.token)
+        self._nodes_cache = {}
+        self._cluster_nodes_endpoint = True
 
     def get_cluster_by_uuid(self, cluster_id):
         return self.restClient.get("clusters/{}".format(cluster_id))
 
+    def get_clusters(self):
+        return self.restClient.get("clusters").json()
+
+    def _iter_cluster_nodes(self, cluster_id):
+        if self._cluster_nodes_endpoint:
+            try:
+                nodes = self.restClient.get("clusters/{}/nodes".format(cluster_id))
+                return iter(nodes.json())
+            except RestClientError as err:
+                if err.status_code not in (404, 405):
+                    raise err
+                logger.debug("Cluster scoped nodes endpoint not available, "
+                             "falling back to /nodes")
+                self._cluster_nodes_endpoint = False
+        nodes = self.restClient.get("/nodes", stream=True)
+        return iter_json_array(nodes)
+
     def get_nodes_by_cluster_uuid(self, cluster_id):
+        if cluster_id in self._nodes_cache:
+            return self._nodes_cache[cluster_id]
+
         master_nodes, worker_nodes = [], []
-        nodes = self.restClient.get("/nodes")
-        # pprint(nodes.json())
-        for node in nodes.json():
+        for node in self._iter_cluster_nodes(cluster_id):
             if node["clusterUuid"] == cluster_id:
                 if node["isMaster"] == 0:
                     worker_nodes.append(node["cloudInstanceId"])
                 else:
                     master_nodes.append(node["cloudInstanceId"])
 
+        self._nodes_cache[cluster_id] = (master_nodes, worker_nodes)
         return master_nodes, worker_nodes
 
 
-class MigrateVolume():
+class RateLimiter():
+    """Token bucket limiting the API calls per second made through a client."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = burst or max(1.0, self.rate)
+        self._tokens = self.capacity
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a call may be made, returns the seconds waited."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.capacity,
+                                   self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def before_call(self, **kwargs):
+        # botocore before-call handler: a non-None return would replace the response
+        self.acquire()
+        return None
+
+
+def epoch_seconds(value):
+    if value.tzinfo is None:
+        return calendar.timegm(value.timetuple()) + value.microsecond / 1e6
+    return value.timestamp()
+
+
+class MigrationMetrics():
+    """
+    Structured timings of a migration run: latency, errors, retries and
+    local rate limiter wait per EC2 API operation (keyed by client method
+    name, e.g. describe_volumes), queue wait per instance and time spent in
+    each modification state per volume. State times are as observed by the
+    poller, so they are accurate to one poll interval.
+    """
+
     def __init__(self):
-        # Required credentials in shared credentials file: ~/.aws/credentials
-        self.ec2_client = boto3.client('ec2')
-        self.polltime = 30
+        self._lock = threading.Lock()
+        self.api = {}
+        self.instances = {}
+        self.volumes = {}
 
-    def check_modification_status(self, volume_id):
-        logger.info("Fetching modfication status for volume [%s].", volume_id)
+    def _api(self, operation):
+        return self.api.setdefault(operation, {
+            "calls": 0, "errors": {}, "retries": 0, "throttled": 0,
+            "latency_seconds_total": 0.0, "latency_seconds_max": 0.0,
+            "rate_limit_wait_seconds_total": 0.0})
+
+    def record_api(self, operation, seconds, error_code=None):
+        with self._lock:
+            stats = self._api(operation)
+            stats["calls"] += 1
+            stats["latency_seconds_total"] += seconds
+            stats["latency_seconds_max"] = max(stats["latency_seconds_max"], seconds)
+            if error_code is not None:
+                stats["errors"][error_code] = stats["errors"].get(error_code, 0) + 1
+                if error_code in THROTTLE_CODES:
+                    stats["throttled"] += 1
+
+    def record_retry(self, operation, error_code=None):
+        with self._lock:
+            stats = self._api(operation)
+            stats["retries"] += 1
+            if error_code in THROTTLE_CODES:
+                stats["throttled"] += 1
+
+    def record_rate_limit_wait(self, operation, seconds):
+        with self._lock:
+            self._api(operation)["rate_limit_wait_seconds_total"] += seconds
+
+    def record_queue_wait(self, instance_id, seconds):
+        with self._lock:
+            self.instances.setdefault(instance_id, {})["queue_wait_seconds"] = seconds
+
+    def record_volume(self, volume_id, instance_id=None, size=None):
+        with self._lock:
+            volume = self.volumes.setdefault(volume_id, {"polls": 0, "seen": {}})
+            if instance_id is not None:
+                volume["instance_id"] = instance_id
+            if size is not None:
+                volume["size"] = size
+
+    def record_state(self, volume_id, modification):
+        state = modification["ModificationState"]
+        with self._lock:
+            volume = self.volumes.setdefault(volume_id, {"polls": 0, "seen": {}})
+            volume["polls"] += 1
+            volume["state"] = state
+            volume["seen"].setdefault(state, time.time())
+            volume["start_time"] = modification.get("StartTime")
+            volume["end_time"] = modification.get("EndTime")
+
+    def _state_seconds(self, volume):
+        start, end = volume.get("start_time"), volume.get("end_time")
+        if start is None:
+            return {}
+        start = epoch_seconds(start)
+        end = epoch_seconds(end) if end is not None else None
+        optimizing = volume["seen"].get("optimizing")
+        seconds = {}
+        modifying_end = optimizing or end
+        if modifying_end is not None:
+            seconds["modifying"] = max(0.0, modifying_end - start)
+        if optimizing is not None and end is not None:
+            seconds["optimizing"] = max(0.0, end - optimizing)
+        if end is not None:
+            seconds["total"] = end - start
+        return seconds
+
+    def volume_rows(self):
+        with self._lock:
+            rows = []
+            for volume_id, volume in sorted(self.volumes.items()):
+                seconds = self._state_seconds(volume)
+                instance = self.instances.get(volume.get("instance_id"), {})
+                rows.append({
+                    "volume_id": volume_id,
+                    "instance_id": volume.get("instance_id"),
+                    "size_gib": volume.get("size"),
+                    "state": volume.get("state"),
+                    "polls": volume["polls"],
+                    "queue_wait_seconds": instance.get("queue_wait_seconds"),
+                    "modifying_seconds": seconds.get("modifying"),
+                    "optimizing_seconds": seconds.get("optimizing"),
+                    "total_seconds": seconds.get("total"),
+                })
+            return rows
+
+    def to_dict(self):
+        rows = self.volume_rows()
+        with self._lock:
+            return {"api": self.api, "instances": self.instances, "volumes": rows}
+
+    def write(self, path):
+        """Write a JSON report, or per-volume CSV rows when path ends with .csv."""
+        if path.endswith(".csv"):
+            rows = self.volume_rows()
+            with open(path, "w") as report:
+                writer = csv.DictWriter(report, fieldnames=[
+                    "volume_id", "instance_id", "size_gib", "state", "polls",
+                    "queue_wait_seconds", "modifying_seconds",
+                    "optimizing_seconds", "total_seconds"])
+                writer.writeheader()
+                writer.writerows(rows)
+        else:
+            with open(path, "w") as report:
+                json.dump(self.to_dict(), report, indent=2, sort_keys=True)
+        logger.info("Wrote migration metrics to %s", path)
+
+    def write_prometheus(self, path):
+        """Write a node_exporter textfile collector file (atomically)."""
+        prefix = "pf9_ebs_migration_"
+        lines = []
+
+        def add(name, kind, help_text, samples):
+            lines.append("# HELP {}{} {}".format(prefix, name, help_text))
+            lines.append("# TYPE {}{} {}".format(prefix, name, kind))
+            for labels, value in samples:
+                label_text = ",".join('{}="{}"'.format(key, labels[key])
+                                      for key in sorted(labels))
+                lines.append("{}{}{{{}}} {}".format(prefix, name, label_text, value))
+
+        data = self.to_dict()
+        api = sorted(data["api"].items())
+        add("api_calls_total", "counter", "EC2 API calls by operation.",
+            [({"operation": op}, stats["calls"]) for op, stats in api])
+        add("api_errors_total", "counter", "EC2 API errors by operation and code.",
+            [({"operation": op, "code": code}, count) for op, stats in api
+             for code, count in sorted(stats["errors"].items())])
+        add("api_retries_total", "counter", "EC2 API attempts retried by botocore.",
+            [({"operation": op}, stats["retries"]) for op, stats in api])
+        add("api_throttled_total", "counter", "Throttled EC2 API attempts.",
+            [({"operation": op}, stats["throttled"]) for op, stats in api])
+        add("api_latency_seconds_sum", "counter",
+            "Total EC2 API latency, without the local rate limiter wait.",
+            [({"operation": op}, stats["latency_seconds_total"]) for op, stats in api])
+        add("api_latency_seconds_max", "gauge", "Slowest EC2 API call.",
+            [({"operation": op}, stats["latency_seconds_max"]) for op, stats in api])
+        add("api_rate_limit_wait_seconds_sum", "counter",
+            "Time calls waited for the local --region-rate limiter.",
+            [({"operation": op}, stats["rate_limit_wait_seconds_total"])
+             for op, stats in api])
+        add("queue_wait_seconds", "gauge", "Time an instance waited for a worker slot.",
+            [({"instance_id": instance_id}, instance["queue_wait_seconds"])
+             for instance_id, instance in sorted(data["instances"].items())
+             if "queue_wait_seconds" in instance])
+        add("volume_state_seconds", "gauge", "Time a volume spent in a modification state.",
+            [({"volume_id": row["volume_id"], "state": state}, row[state + "_seconds"])
+             for row in data["volumes"] for state in ("modifying", "optimizing", "total")
+             if row[state + "_seconds"] is not None])
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as textfile:
+            textfile.write("\n".join(lines) + "\n")
+        os.rename(tmp_path, path)
+        logger.info("Wrote Prometheus metrics to %s", path)
+
+
+class InstrumentedClient():
+    """
+    Wraps an EC2 client and records the latency and error code of every API
+    call (including each page fetched through a paginator) in MigrationMetrics.
+    Retries done inside botocore are counted when botocore sends the next
+    attempt. With a limiter, calls wait for it first and that wait is recorded
+    apart from the latency.
+    """
+
+    def __init__(self, client, metrics, limiter=None):
+        self._client = client
+        self._metrics = metrics
+        self._limiter = limiter
+        self._waited = threading.local()
+        events = self._client.meta.events
+        events.register("needs-retry", self._on_needs_retry)
+        events.register("request-created", self._on_request_created)
+        if limiter is not None:
+            events.register("before-call", self._on_before_call)
+
+    @staticmethod
+    def _operation(api_name):
+        # Same key as the client method names used by _timed
+        return botocore.xform_name(api_name)
+
+    def _on_needs_retry(self, response=None, caught_exception=None, request_dict=None,
+                        **kwargs):
+        # Fires after every attempt, retried or not: only remember the error
+        if request_dict is None:
+            return None
+        if response is not None:
+            error_code = response[1].get("Error", {}).get("Code")
+        else:
+            error_code = type(caught_exception).__name__ if caught_exception else None
+        request_dict["context"]["migration_last_error"] = error_code
+        return None
+
+    def _on_request_created(self, request=None, operation_name=None, **kwargs):
+        context = getattr(request, "context", None) or {}
+        if context.get("retries", {}).get("attempt", 1) > 1:
+            self._metrics.record_retry(self._operation(operation_name),
+                                       context.get("migration_last_error"))
+
+    def _on_before_call(self, event_name=None, **kwargs):
+        waited = self._limiter.acquire()
+        self._waited.seconds = getattr(self._waited, "seconds", 0.0) + waited
+        self._metrics.record_rate_limit_wait(
+            self._operation(event_name.rsplit(".", 1)[-1]), waited)
+        return None
+
+    def _start(self):
+        self._waited.seconds = 0.0
+        return time.time()
+
+    def _elapsed(self, start):
+        return time.time() - start - self._waited.seconds
+
+    def _timed(self, operation, call, *args, **kwargs):
+        start = self._start()
         try:
-            response = self.ec2_client.describe_volumes_modifications(VolumeIds=[
-                volume_id, ])
+            result = call(*args, **kwargs)
         except botocore.exceptions.ClientError as err:
-            if err.response["Error"]["Code"] == "InvalidVolumeModification.NotFound":
-                logger.warning(err.response["Error"]["Message"])
+            self._metrics.record_api(operation, self._elapsed(start),
+                                     err.response["Error"]["Code"])
+            raise
+        except Exception:
+            self._metrics.record_api(operation, self._elapsed(start), "Exception")
+            raise
+        self._metrics.record_api(operation, self._elapsed(start))
+        return result
+
+    def _timed_pages(self, operation, pages):
+        while True:
+            start = self._start()
+            try:
+                page = next(pages)
+            except StopIteration:
                 return
-            raise err
+            except botocore.exceptions.ClientError as err:
+                self._metrics.record_api(operation, self._elapsed(start),
+                                         err.response["Error"]["Code"])
+                raise
+            self._metrics.record_api(operation, self._elapsed(start))
+            yield page
+
+    def get_paginator(self, operation):
+        paginator = self._client.get_paginator(operation)
+        instrumented = self
+
+        class Paginator(object):
+            def paginate(self, **kwargs):
+                return instrumented._timed_pages(
+                    operation, iter(paginator.paginate(**kwargs)))
+        return Paginator()
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name.startswith("_") or name == "meta" or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return self._timed(name, attr, *args, **kwargs)
+        return call
+
+
+class Ec2Region():
+    """
+    EC2 client, API rate budget and modification poller shared by every
+    cluster migrated in one AWS region. region=None uses the default region
+    from the shared AWS config.
+    """
+
+    def __init__(self, region=None, rate=None, backoff=None, ec2_client=None,
+                 metrics=None, cloudwatch_client=None):
+        self.region = region
+        # Required credentials in shared credentials file: ~/.aws/credentials
+        self.ec2_client = ec2_client or boto3.client('ec2', region_name=region)
+        self.limiter = RateLimiter(rate) if rate else None
+        if metrics is not None:
+            # Waits for the limiter itself, to keep them out of the latency
+            self.ec2_client = InstrumentedClient(self.ec2_client, metrics, self.limiter)
+        elif self.limiter is not None:
+            self.ec2_client.meta.events.register("before-call.ec2",
+                                                 self.limiter.before_call)
+        self.backoff = backoff or PollBackoff()
+        self.poller = ModificationPoller(self.ec2_client, self.backoff)
+        self.metrics = metrics
+        self._cloudwatch_client = cloudwatch_client
+
+    def cloudwatch_client(self):
+        # Only created when gp3 sizing reads CloudWatch
+        if self._cloudwatch_client is None:
+            self._cloudwatch_client = boto3.client('cloudwatch', region_name=self.region)
+            if self.metrics is not None:
+                self._cloudwatch_client = InstrumentedClient(self._cloudwatch_client,
+                                                             self.metrics)
+        return self._cloudwatch_client
+
+
+class MigrationJournal():
+    """
+    Append-only JSON-lines journal of instance and volume migration states
+    for one cluster. With resume=True the existing journal is replayed so
+    finished work can be skipped; readonly=True only replays it.
+    """
+    STATES = ("pending", "modifying", "optimizing", "completed", "failed")
+    FILE_PREFIX = "gp3-migration-"
+
+    def __init__(self, cluster_id, journal_dir=".", resume=False, readonly=False):
+        self.cluster_id = cluster_id
+        self.path = os.path.join(
+            journal_dir, "{}{}.jsonl".format(self.FILE_PREFIX, cluster_id))
+        self._lock = threading.Lock()
+        self.instances = {}
+        self.volumes = {}
+        self._file = None
+        if resume or readonly:
+            self._load()
+        if not readonly:
+            self._file = open(self.path, "a" if resume else "w")
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            logger.warning("No journal found at %s", self.path)
+            return
+        with open(self.path) as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Last line may be torn if the previous run was killed
+                    continue
+                self._apply(entry)
+        logger.info("Loaded journal %s: %s instances, %s volumes",
+                    self.path, len(self.instances), len(self.volumes))
+
+    def _apply(self, entry):
+        if entry["kind"] == "instance":
+            self.instances[entry["id"]] = entry["state"]
+        else:
+            self.volumes.setdefault(entry["id"], {}).update(entry)
+
+    def _write(self, entry):
+        entry.update(cluster=self.cluster_id, time=time.time())
+        with self._lock:
+            self._apply(entry)
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+
+    def record_instance(self, instance_id, state):
+        if self.instances.get(instance_id) != state:
+            self._write({"kind": "instance", "id": instance_id, "state": state})
+
+    def record_volume(self, volume_id, state, **extra):
+        if extra or self.volume_state(volume_id) != state:
+            self._write(dict(extra, kind="volume", id=volume_id, state=state))
+
+    def instance_state(self, instance_id):
+        return self.instances.get(instance_id)
 
-        while response["VolumesModifications"][0]["ModificationState"] != "completed":
-            time.sleep(self.polltime)
-            response = self.ec2_client.describe_volumes_modifications(VolumeIds=[
-                volume_id, ])
-            logger.info("Polling volume(%s) status: %s", volume_id,
-                        response["VolumesModifications"][0]["ModificationState"])
+    def volume_state(self, volume_id):
+        return self.volumes.get(volume_id, {}).get("state")
 
-        timetaken = response["VolumesModifications"][0]["EndTime"] - \
-            response["VolumesModifications"][0]["StartTime"]
+    def volume_index(self):
+        index = {instance_id: [] for instance_id in self.instances}
+        for record in self.volumes.values():
+            if record.get("instance_id") in index:
+                index[record["instance_id"]].append(record["volume"])
+        return index
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def load_history(journal_dir):
+    """
+    Collect seconds-per-GiB samples for each modification state from the
+    journals of earlier runs in journal_dir.
+    """
+    samples = {"modifying": [], "optimizing": [], "completed": []}
+    pattern = os.path.join(journal_dir, MigrationJournal.FILE_PREFIX + "*.jsonl")
+    for path in glob.glob(pattern):
+        cluster_id = os.path.basename(path)[
+            len(MigrationJournal.FILE_PREFIX):-len(".jsonl")]
+        journal = MigrationJournal(cluster_id, journal_dir, readonly=True)
+        for record in journal.volumes.values():
+            size = record.get("volume", {}).get("Size")
+            if not size:
+                continue
+            for state in samples:
+                seconds = record.get(state + "_seconds")
+                if seconds is not None:
+                    samples[state].append(seconds / float(size))
+    return samples
+
+
+class Gp3Sizer():
+    """
+    Picks per-volume gp3 IOPS and throughput from the volume's I/O history so
+    it doesn't lose performance leaving gp2: the peak IOPS and MiB/s over the
+    history (per `period` seconds) times `headroom`, never below the volume's
+    gp2 baseline (3 IOPS/GiB, at least 3000, and 250 MiB/s above 170 GiB) and
+    within the gp3 limits.
+
+    The period defaults to the finest one CloudWatch keeps for `days`
+    (1 minute up to 15 days back), wider buckets average bursts away.
+
+    History is read from CloudWatch (AWS/EBS, batched GetMetricData calls
+    returning only the per-volume read+write rates, whose peaks are kept while
+    paging) or from a JSON file holding the per-period sums, for offline runs:
+        {"period": 60,
+         "volumes": {"vol-1": {"VolumeReadOps": [...], "VolumeWriteOps": [...],
+                               "VolumeReadBytes": [...], "VolumeWriteBytes": [...]}}}
+    """
+    METRICS = ("VolumeReadOps", "VolumeWriteOps", "VolumeReadBytes", "VolumeWriteBytes")
+    MAX_QUERIES = 500
+    # Metric queries of one volume, its 4 series and the IOPS and MiB/s expressions
+    QUERIES_PER_VOLUME = len(METRICS) + 2
+    GP3_IOPS = (3000, 16000)
+    GP3_THROUGHPUT = (125, 1000)
+    MAX_IOPS_PER_GIB = 500
+    MAX_MIBPS_PER_IOPS = 0.25
+    # gp2 delivers 250 MiB/s above 170 GiB, up to it 128 MiB/s, about the gp3 baseline
+    GP2_THROUGHPUT = (170, 250)
+    # (days back, finest GetMetricData period) from the CloudWatch retention
+    PERIODS = ((15, 60), (63, 300))
+
+    def __init__(self, cloudwatch_client=None, metrics_file=None, days=14, headroom=1.2,
+                 period=None):
+        self.cloudwatch_client = cloudwatch_client
+        self.metrics_file = metrics_file
+        self.days = days
+        self.headroom = headroom
+        self.period = period or next((seconds for limit, seconds in self.PERIODS if days <= limit), 3600)
+        if self.period > 60 and not metrics_file:
+            logger.warning("Sizing from %s days of history uses %ss CloudWatch periods, "
+                           "short bursts are averaged away", days, self.period)
+
+    def _load_file(self, volume_ids):
+        with open(self.metrics_file) as f:
+            data = json.load(f)
+        self.period = data.get("period", self.period)
+        history = {}
+        for volume_id in volume_ids:
+            metrics = data.get("volumes", {}).get(volume_id)
+            if metrics:
+                # Values are aligned by position, use it as the timestamp
+                history[volume_id] = {name: dict(enumerate(metrics.get(name, [])))
+                                      for name in self.METRICS}
+        return history
+
+    def _volume_queries(self, index, volume_id):
+        series = ["v{}m{}".format(index, i) for i in range(len(self.METRICS))]
+        queries = [{
+            "Id": query_id,
+            "MetricStat": {
+                "Metric": {
+                    "Namespace": "AWS/EBS",
+                    "MetricName": name,
+                    "Dimensions": [{"Name": "VolumeId", "Value": volume_id}],
+                },
+                "Period": self.period,
+                "Stat": "Sum",
+            },
+            # Only the rates below are returned
+            "ReturnData": False,
+        } for query_id, name in zip(series, self.METRICS)]
+        # Read and write sums of a period, as per second rates
+        for rate, read, write, scale in (("iops", series[0], series[1], 1),
+                                         ("mibps", series[2], series[3], 1024 * 1024)):
+            queries.append({
+                "Id": "v{}{}".format(index, rate),
+                "Expression": "(FILL({}, 0) + FILL({}, 0)) / {}".format(
+                    read, write, scale * self.period),
+                "ReturnData": True,
+            })
+        return queries
+
+    def _query_cloudwatch(self, volume_ids):
+        """{volume_id: (peak IOPS, peak MiB/s)}, the series are not kept."""
+        end = datetime.datetime.now(datetime.timezone.utc)
+        start = end - datetime.timedelta(days=self.days)
+        peaks = {}
+        paginator = self.cloudwatch_client.get_paginator("get_metric_data")
+        per_call = self.MAX_QUERIES // self.QUERIES_PER_VOLUME
+        for i in range(0, len(volume_ids), per_call):
+            batch, outputs = [], {}
+            for index, volume_id in enumerate(volume_ids[i:i + per_call], i):
+                batch.extend(self._volume_queries(index, volume_id))
+                outputs["v{}iops".format(index)] = (volume_id, 0)
+                outputs["v{}mibps".format(index)] = (volume_id, 1)
+            for page in paginator.paginate(MetricDataQueries=batch, StartTime=start,
+                                           EndTime=end):
+                for result in page["MetricDataResults"]:
+                    if not result["Values"]:
+                        continue
+                    volume_id, rate = outputs[result["Id"]]
+                    peak = peaks.setdefault(volume_id, [0, 0])
+                    peak[rate] = max(peak[rate], max(result["Values"]))
+        return {volume_id: tuple(peak) for volume_id, peak in peaks.items()}
+
+    def peak_rates(self, volume_ids):
+        """{volume_id: (peak IOPS, peak MiB/s)} of the volumes with history."""
+        if self.metrics_file:
+            return {volume_id: self.peaks(metrics)
+                    for volume_id, metrics in self._load_file(volume_ids).items()}
+        return self._query_cloudwatch(volume_ids)
+
+    def peaks(self, metrics):
+        """Peak IOPS and MiB/s of one volume's {metric name: {timestamp: sum over the period}}."""
+        def per_second(read, write, scale=1):
+            series = metrics.get(read, {})
+            other = metrics.get(write, {})
+            return max([(series.get(key, 0) + other.get(key, 0)) / scale / self.period
+                        for key in set(series) | set(other)] or [0])
+        return (per_second("VolumeReadOps", "VolumeWriteOps"),
+                per_second("VolumeReadBytes", "VolumeWriteBytes", 1024 * 1024))
+
+    def target(self, vol, peak_iops=0, peak_mibps=0):
+        size = vol["Size"]
+        iops = min(3 * size, self.GP3_IOPS[1])
+        iops = max(iops, math.ceil(peak_iops * self.headroom))
+        throughput = min(math.ceil(peak_mibps * self.headroom), self.GP3_THROUGHPUT[1])
+        if size > self.GP2_THROUGHPUT[0]:
+            throughput = max(throughput, self.GP2_THROUGHPUT[1])
+        # gp3 needs 4 IOPS per MiB/s above the baseline
+        iops = max(iops, math.ceil(throughput / self.MAX_MIBPS_PER_IOPS))
+        iops = max(self.GP3_IOPS[0], min(iops, self.GP3_IOPS[1], self.MAX_IOPS_PER_GIB * size))
+        throughput = max(self.GP3_THROUGHPUT[0],
+                         min(throughput, int(iops * self.MAX_MIBPS_PER_IOPS)))
+        params = {}
+        # Leave the gp3 defaults to modify_volume
+        if iops != self.GP3_IOPS[0]:
+            params["Iops"] = iops
+        if throughput != self.GP3_THROUGHPUT[0]:
+            params["Throughput"] = throughput
+        return params
+
+    def targets(self, vols):
+        """modify_volume Iops/Throughput for each gp2 volume summary in vols."""
+        rates = self.peak_rates([vol["VolumeId"] for vol in vols])
+        targets = {}
+        for vol in vols:
+            peak_iops, peak_mibps = rates.get(vol["VolumeId"], (0, 0))
+            targets[vol["VolumeId"]] = self.target(vol, peak_iops, peak_mibps)
+            logger.info("Sizing volume %s (%s GiB): peak %.0f IOPS, %.1f MiB/s -> gp3 %s",
+                        vol["VolumeId"], vol["Size"], peak_iops, peak_mibps,
+                        targets[vol["VolumeId"]] or "defaults (3000 IOPS, 125 MiB/s)")
+        return targets
+
+
+class MigrationPlanner():
+    """
+    Dry-run planner: summarizes the discovered volumes and estimates the
+    wall-clock time of a migration from per-GiB durations of earlier runs.
+    """
+    # Rough fallback when no earlier run was journaled
+    DEFAULT_SECONDS_PER_GIB = {"modifying": 0.1, "optimizing": 0.5, "completed": 3.0}
+    MIN_VOLUME_SECONDS = 30
+
+    def __init__(self, volume_index, history=None, journal=None,
+                 wait_for="completed", master_wait_for="completed"):
+        self.volume_index = volume_index
+        self.history = history or {}
+        self.journal = journal
+        self.wait_for = wait_for
+        self.master_wait_for = master_wait_for
+
+    def seconds_per_gib(self, state):
+        samples = sorted(self.history.get(state, []))
+        if not samples:
+            return self.DEFAULT_SECONDS_PER_GIB[state]
+        return samples[len(samples) // 2]
+
+    def volume_seconds(self, vol, state):
+        return max(self.MIN_VOLUME_SECONDS, vol["Size"] * self.seconds_per_gib(state))
+
+    def split_volumes(self, instance_id):
+        to_migrate, skipped = [], []
+        for vol in self.volume_index.get(instance_id, []):
+            if self.journal is not None and \
+                    self.journal.volume_state(vol["VolumeId"]) == "completed":
+                skipped.append((vol, "already migrated"))
+            elif vol["VolumeType"] != "gp2":
+                skipped.append((vol, "volume type is {}".format(vol["VolumeType"])))
+            else:
+                to_migrate.append(vol)
+        return to_migrate, skipped
+
+    def instance_seconds(self, instance_id, state):
+        to_migrate, _ = self.split_volumes(instance_id)
+        # An instance's volumes are modified together, the slowest one sets its time
+        return max([self.volume_seconds(vol, state) for vol in to_migrate] or [0])
+
+    def estimate(self, master_nodes, worker_nodes, concurrency):
+        # Masters run one after another, workers keep `concurrency` slots busy
+        total = sum(self.instance_seconds(instance_id, self.master_wait_for)
+                    for instance_id in master_nodes)
+        slots = [0] * max(1, concurrency)
+        for instance_id in worker_nodes:
+            heapq.heapreplace(slots, slots[0] +
+                              self.instance_seconds(instance_id, self.wait_for))
+        return total + max(slots)
+
+    def report(self, master_nodes, worker_nodes, concurrency):
+        to_migrate, skipped = [], []
+        for instance_id in master_nodes + worker_nodes:
+            migrate, skip = self.split_volumes(instance_id)
+            to_migrate.extend(migrate)
+            skipped.extend(skip)
+
+        logger.info("Plan: %s gp2 volumes to migrate, %s GiB total",
+                    len(to_migrate), sum(vol["Size"] for vol in to_migrate))
+        for state in ("optimizing", "completed"):
+            logger.info("Plan: %.2f seconds/GiB to reach %s (%s)", self.seconds_per_gib(state),
+                        state, "{} samples".format(len(self.history.get(state, [])))
+                        if self.history.get(state) else "default, no history")
+        estimate = self.estimate(master_nodes, worker_nodes, concurrency)
+        logger.info("Plan: estimated wall-clock with workerbatchsize %s and wait-for %s: %s",
+                    concurrency, self.wait_for,
+                    datetime.timedelta(seconds=int(estimate)))
+        for size in sorted(set([1, 2, 5, 10, 20, concurrency])):
+            logger.info("Plan:   workerbatchsize %3s -> %s", size, datetime.timedelta(
+                seconds=int(self.estimate(master_nodes, worker_nodes, size))))
+        for vol, reason in skipped:
+            logger.info("Plan: skipping volume %s (%s GiB): %s",
+                        vol["VolumeId"], vol.get("Size"), reason)
+        return estimate
+
+
+class MigrateVolume():
+    def __init__(self, journal=None, wait_for="completed", region=None,
+                 metrics=None, master_wait_for="completed", run_log=None):
+        region = region or Ec2Region(metrics=metrics)
+        self.region = region.region
+        self.run_log = run_log
+        self.metrics = metrics
+        self.ec2_client = region.ec2_client
+        self.backoff = region.backoff
+        self.poller = region.poller
+        self.journal = journal
+        self.wait_for = wait_for
+        self.master_wait_for = master_wait_for
+        self.volume_index = {}
+        self.gp3_targets = {}
+        self.released_early = set()
+        self.background_failures = []
+
+    def _on_modification_update(self, volume_id, modification):
+        state = modification["ModificationState"]
+        if self.metrics is not None:
+            self.metrics.record_state(volume_id, modification)
+        if self.journal is not None and self.journal.volume_state(volume_id) != state:
+            # Journal elapsed time per state so later --plan runs can estimate
+            end_time = modification.get("EndTime") or \
+                datetime.datetime.now(modification["StartTime"].tzinfo)
+            self.journal.record_volume(volume_id, state, **{
+                state + "_seconds": (end_time - modification["StartTime"]).total_seconds()})
+        if volume_id not in self.released_early:
+            return
+        if state == "completed":
+            logger.info("Volume modified in background: %s: %s. Total timetaken: %s",
+                        volume_id, state,
+                        modification["EndTime"] - modification["StartTime"])
+        elif state == "failed":
+            logger.error("Volume %s modification failed in background: %s",
+                         volume_id, modification.get("StatusMessage"))
+            self.background_failures.append(volume_id)
+
+    def _volume_state(self, volume_id):
+        if self.journal is None:
+            return None
+        return self.journal.volume_state(volume_id)
+
+    def _record_volume(self, volume_id, state):
+        if self.journal is not None:
+            self.journal.record_volume(volume_id, state)
+
+    def _record_instance(self, instance_id, state):
+        if self.journal is not None:
+            self.journal.record_instance(instance_id, state)
+
+    def check_modification_status(self, volume_id, wait_for=None):
+        logger.info("Fetching modfication status for volume [%s].", volume_id)
+        modification = self.poller.wait(volume_id, wait_for or self.wait_for,
+                                        self._on_modification_update)
+        if modification is None:
+            return None
+
+        if modification["ModificationState"] == "failed":
+            raise Exception("Volume {} modification failed: {}".format(
+                volume_id, modification.get("StatusMessage")))
+
+        if modification["ModificationState"] != "completed":
+            self.released_early.add(volume_id)
+            logger.info("Volume %s reached %s (progress: %s), completion is "
+                        "tracked in background", volume_id,
+                        modification["ModificationState"], modification.get("Progress"))
+            return modification
+
+        timetaken = modification["EndTime"] - modification["StartTime"]
         logger.info("Volume modified: %s: %s. Total timetaken: %s", volume_id,
-                    response["VolumesModifications"][0]["ModificationState"], timetaken)
+                    modification["ModificationState"], timetaken)
+        return modification
 
-    def migrate_volume_to_GP3(self, instance_id):
-        logger.info(
-            "Batch migrate_volume_to_GP3 for instance: %s ", instance_id)
+    def follow_in_flight_volumes(self):
+        """
+        Track journaled volumes whose instance was already released but that
+        had not finished optimizing when the previous run stopped.
+        """
+        if self.journal is None:
+            return
+        for volume_id, record in list(self.journal.volumes.items()):
+            if record.get("state") in ("modifying", "optimizing") and \
+                    self.journal.instance_state(record.get("instance_id")) == "completed":
+                self.released_early.add(volume_id)
+                self.poller.track(volume_id, on_update=self._on_modification_update)
+
+    def wait_for_background(self):
+        if self.released_early:
+            logger.info("Waiting for %s volumes released early to complete",
+                        len(self.released_early))
+        self.poller.drain(self.released_early)
+        return self.background_failures
+
+    def discover_volumes(self, instance_ids, filter_batch_size=200):
+        """
+        Fetch the volumes attached to every given instance with a few
+        paginated describe_volumes calls and index them by instance id.
+        Instances already present in the journal are not rediscovered.
+        """
+        known = self.journal.volume_index() if self.journal is not None else {}
+        undiscovered = [instance_id for instance_id in instance_ids
+                        if instance_id not in known]
+        self.volume_index = {instance_id: [] for instance_id in undiscovered}
+        paginator = self.ec2_client.get_paginator("describe_volumes")
+        for i in range(0, len(undiscovered), filter_batch_size):
+            filter = [{
+                'Name': 'attachment.instance-id',
+                'Values': undiscovered[i:i + filter_batch_size]
+            }]
+            for page in paginator.paginate(Filters=filter):
+                for vol in page["Volumes"]:
+                    for attachment in vol["Attachments"]:
+                        if attachment["InstanceId"] in self.volume_index:
+                            self.volume_index[attachment["InstanceId"]].append(
+                                volume_summary(vol))
+
+        if self.journal is not None:
+            for instance_id in undiscovered:
+                self.journal.record_instance(instance_id, "pending")
+                for vol in self.volume_index[instance_id]:
+                    self.journal.record_volume(vol["VolumeId"], "pending",
+                                               instance_id=instance_id, volume=vol)
+
+        for instance_id in instance_ids:
+            if instance_id in known:
+                self.volume_index[instance_id] = known[instance_id]
+
+        logger.info("Discovered %s volumes across %s instances (%s from journal)",
+                    sum(len(vols) for vols in self.volume_index.values()),
+                    len(instance_ids), len(instance_ids) - len(undiscovered))
+        return self.volume_index
+
+    def size_volumes(self, sizer):
+        """Pick gp3 IOPS/throughput for every discovered gp2 volume, see Gp3Sizer."""
+        vols = [vol for vols in self.volume_index.values() for vol in vols
+                if vol.get("VolumeType") == "gp2"]
+        self.gp3_targets = sizer.targets(vols)
+        return self.gp3_targets
+
+    def get_instance_volumes(self, instance_id):
+        if instance_id in self.volume_index:
+            return self.volume_index[instance_id]
         filter = [{
             'Name': 'attachment.instance-id',
             'Values': [instance_id, ]
         }]
+        response = self.ec2_client.describe_volumes(Filters=filter)
+        return response["Volumes"]
+
+    def migrate_volume_to_GP3(self, instance_id, wait_for=None):
+        """
+        Start the modification of every gp2 volume of the instance, then wait
+        for all of them together (the shared poller batches their status)
+        until they reach wait_for, --wait-for by default.
+        Raises the first error once every started volume has been waited on.
+        """
+        logger.info(
+            "Batch migrate_volume_to_GP3 for instance: %s ", instance_id)
+        if self.journal is not None and \
+                self.journal.instance_state(instance_id) == "completed":
+            logger.info("Instance %s already migrated, skipping", instance_id)
+            return
+
+        errors = []
         try:
-            response = self.ec2_client.describe_volumes(Filters=filter)
-            for vol in response["Volumes"]:
+            in_flight = []
+            for vol in self.get_instance_volumes(instance_id):
                 volume_id = vol["VolumeId"]
-                if vol["VolumeType"] == "gp2":
-                    logger.info("Modifiying volume: %s", volume_id)
-                    self.ec2_client.modify_volume(
-                        VolumeId=volume_id, VolumeType='gp3')
-                self.check_modification_status(volume_id)
+                if self.metrics is not None:
+                    self.metrics.record_volume(volume_id, instance_id, vol.get("Size"))
+                state = self._volume_state(volume_id)
+                if state == "completed":
+                    logger.info("Volume %s already migrated, skipping", volume_id)
+                    continue
+                if state not in ("modifying", "optimizing") and vol["VolumeType"] != "gp2":
+                    # Not modified by this run, nothing to poll or journal
+                    logger.info("Volume %s is %s, skipping", volume_id, vol["VolumeType"])
+                    continue
+                try:
+                    if state in ("modifying", "optimizing"):
+                        logger.info("Resuming status polling for volume: %s", volume_id)
+                    else:
+                        if self.run_log is not None:
+                            # Attributes from discovery (or the journal on --resume)
+                            self.run_log.snapshot(
+                                volume_id, self.region, vol, instance_id=instance_id,
+                                cluster=self.journal.cluster_id if self.journal else None)
+                        logger.info("Modifiying volume: %s", volume_id)
+                        self.ec2_client.modify_volume(
+                            VolumeId=volume_id, VolumeType='gp3',
+                            **self.gp3_targets.get(volume_id, {}))
+                        self._record_volume(volume_id, "modifying")
+                    in_flight.append(volume_id)
+                except Exception as err:
+                    self._record_volume(volume_id, "failed")
+                    errors.append(err)
+
+            for volume_id in in_flight:
+                try:
+                    if self.check_modification_status(volume_id, wait_for) is None:
+                        self._record_volume(volume_id, "completed")
+                except Exception as err:
+                    self._record_volume(volume_id, "failed")
+                    errors.append(err)
         except Exception as err:
-            logger.error("Failed to migrate volume to GP3. Error: %s", str(err))
-            raise err
+            errors.append(err)
 
-    def batch_migrate_volumes(self, instance_ids):
-        threads = []
-        for i in range(len(instance_ids)):
-            thread = threading.Thread(target=self.migrate_volume_to_GP3,
-                                      args=(instance_ids[i],))
-            threads.append(thread)
+        if errors:
+            self._record_instance(instance_id, "failed")
+            for err in errors:
+                logger.error("Failed to migrate volume to GP3. Error: %s", str(err))
+            raise errors[0]
+        self._record_instance(instance_id, "completed")
 
-        for i in threads:
-            i.start()
+    def migrate_masters(self, master_nodes):
+        """
+        Rolling master migration: all volumes of one master are modified
+        concurrently, and the next master only starts once every volume of the
+        previous one reached master_wait_for (never "modifying", whatever the
+        workers' --wait-for). Only one master is ever in flight, so etcd
+        quorum is never put at risk, and the roll stops at the first failing
+        master.
+        """
+        for i, master_node in enumerate(master_nodes):
+            logger.info("Rolling master migration %s/%s: %s", i + 1,
+                        len(master_nodes), master_node)
+            try:
+                self.migrate_volume_to_GP3(master_node, self.master_wait_for)
+            except Exception:
+                logger.error("Stopping rolling master migration at %s, "
+                             "remaining masters untouched: %s", master_node,
+                             master_nodes[i + 1:])
+                raise
 
-        for i in threads:
-            i.join()
+    def batch_migrate_volumes(self, instance_ids, max_parallel=5):
+        """
+        Migrate instances with at most max_parallel in flight, starting the
+        next instance as soon as any slot frees. Returns a dict mapping each
+        instance id to None on success or to the raised exception.
+        """
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            futures = {
+                executor.submit(self._migrate_queued, instance_id, time.time()): instance_id
+                for instance_id in instance_ids
+            }
+            for future in concurrent.futures.as_completed(futures):
+                instance_id = futures[future]
+                results[instance_id] = future.exception()
+                if results[instance_id] is None:
+                    logger.info("Migration for node(%s) volumes to GP3 done!",
+                                instance_id)
+                else:
+                    logger.error("Migration for node(%s) volumes to GP3 failed. Error: %s",
+                                 instance_id, str(results[instance_id]))
+        return results
 
+    def _migrate_queued(self, instance_id, queued_at):
+        if self.metrics is not None:
+            self.metrics.record_queue_wait(instance_id, time.time() - queued_at)
+        return self.migrate_volume_to_GP3(instance_id)
 
-if __name__ == '__main__':
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--kdu', type=str, required=True)
-    parser.add_argument('--tenant', type=str, required=True)
-    parser.add_argument('--cluster_id', type=str, required=True)
-    parser.add_argument('--username', default="", type=str, required=True)
-    parser.add_argument('--password', default="", type=str, required=True)
-    parser.add_argument('--workerbatchsize', default=5, type=int, required=False)
+def volume_summary(vol):
+    return {key: vol[key] for key in
+            ("VolumeId", "VolumeType", "Size", "Iops", "Throughput", "MultiAttachEnabled")
+            if key in vol}
 
-    args = parser.parse_args()
 
-    qbertClient = QbertAPI(args.kdu, args.tenant, args.username, args.password)
-    cluster_id = args.cluster_id
-    migratevol = MigrateVolume()
+def report_results(results):
+    failed = [instance_id for instance_id, err in results.items() if err is not None]
+    logger.info("Migration summary: %s instances, %s succeeded, %s failed",
+                len(results), len(results) - len(failed), len(failed))
+    for instance_id, err in results.items():
+        logger.info("  %s: %s", instance_id,
+                    "ok" if err is None else "failed ({})".format(err))
+    return failed
+
+
+def cluster_region(cluster):
+    return (cluster.get("cloudProperties") or {}).get("region") or cluster.get("region")
+
+
+def resolve_clusters(qbertClient, selectors):
+    """
+    Expand --cluster_id values (UUIDs, globs on UUID or name, or "all" for
+    every AWS cluster in the tenant) into qbert cluster dicts.
+    """
+    if all(selector != "all" and not any(c in selector for c in "*?[")
+           for selector in selectors):
+        return [qbertClient.get_cluster_by_uuid(cluster_id).json()
+                for cluster_id in selectors]
+
+    clusters = []
+    for cluster in qbertClient.get_clusters():
+        for selector in selectors:
+            if selector == "all":
+                matched = cluster.get("cloudProviderType") == "aws"
+            else:
+                matched = fnmatch.fnmatch(cluster["uuid"], selector) or \
+                    fnmatch.fnmatch(cluster["name"], selector)
+            if matched:
+                clusters.append(cluster)
+                break
+    return clusters
+
+
+def migrate_cluster(qbertClient, cluster, region, args, metrics=None, run_log=None):
+    cluster_id = cluster["uuid"]
     batchSize = args.workerbatchsize
+    journal = MigrationJournal(cluster_id, args.journal_dir, args.resume,
+                               readonly=args.plan)
+    migratevol = MigrateVolume(None if args.plan else journal, args.wait_for, region,
+                               metrics, args.master_wait_for,
+                               None if args.plan else run_log)
 
     try:
-        # get cluster
-        logger.info("Fetching cluster [%s] information.", cluster_id)
-        cluster_resp = qbertClient.get_cluster_by_uuid(cluster_id)
-        logger.info("cluster %s", cluster_resp.json()["name"])
+        logger.info("cluster %s (%s), region %s", cluster["name"], cluster_id,
+                    region.region or "default")
 
         master_nodes, worker_nodes = qbertClient.get_nodes_by_cluster_uuid(
             cluster_id)
 
         if not (master_nodes and worker_nodes):
             logger.warning(
-                "cluster %s doesn't have any master/worker nodes to migrate volume", cluster_resp.json()["name"])
+                "cluster %s doesn't have any master/worker nodes to migrate volume", cluster["name"])
 
         logger.info("Master nodes %s Worker nodes %s ",
                     master_nodes, worker_nodes)
-        # Migrate volumes for master nodes
-        for master_node in master_nodes:
-            logger.info("Migrating masternode (%s) volumes to GP3",
-                        cluster_resp.json()["name"])
-            migratevol.migrate_volume_to_GP3(master_node)
-
-        # Migrate volumes for worker nodes in batch of 5
-        for i in range(0, len(worker_nodes), batchSize):
-            logger.info("Migrating worker nodes (%s) to GP3 volumetype",
-                        worker_nodes[i:i + batchSize])
-            migratevol.batch_migrate_volumes(worker_nodes[i:i + batchSize])
-            logger.info("Migration for worker nodes(%s) volumes to GP3 done!",
-                        worker_nodes[i:i + batchSize])
+        migratevol.discover_volumes(master_nodes + worker_nodes)
+        if args.size_metrics_file:
+            migratevol.size_volumes(Gp3Sizer(metrics_file=args.size_metrics_file,
+                                             headroom=args.size_headroom))
+        elif args.size_gp3:
+            migratevol.size_volumes(Gp3Sizer(region.cloudwatch_client(),
+                                             days=args.size_days,
+                                             headroom=args.size_headroom))
+        if args.plan:
+            planner = MigrationPlanner(migratevol.volume_index,
+                                       load_history(args.journal_dir),
+                                       journal, args.wait_for, args.master_wait_for)
+            planner.report(master_nodes, worker_nodes, batchSize)
+            return True
+        if args.resume:
+            migratevol.follow_in_flight_volumes()
+
+        # Migrate volumes for master nodes, one master at a time
+        logger.info("Migrating masternode (%s) volumes to GP3",
+                    cluster["name"])
+        migratevol.migrate_masters(master_nodes)
+
+        # Migrate volumes for worker nodes, keeping batchSize nodes in flight
+        logger.info("Migrating worker nodes (%s) to GP3 volumetype, %s at a time",
+                    worker_nodes, batchSize)
+        results = migratevol.batch_migrate_volumes(worker_nodes, batchSize)
+
+        failed = report_results(results)
+        background_failures = migratevol.wait_for_background()
+        if background_failures:
+            logger.error("Volumes failed after their node was released: %s",
+                         background_failures)
+        return not (failed or background_failures)
+    finally:
+        journal.close()
+
 
+def rollback_cluster(cluster, region, args, run_log):
+    originals = run_log.originals(region.region, cluster=cluster["uuid"])
+    if not originals:
+        logger.warning("No volumes of cluster %s recorded in %s, nothing to revert",
+                       cluster["name"], run_log.path)
+        return True
+    logger.info("Rolling back cluster %s (%s), region %s", cluster["name"],
+                cluster["uuid"], region.region or "default")
+    rollback = VolumeRollback(region.ec2_client,
+                              lambda volume_id: region.poller.wait(volume_id, args.wait_for),
+                              run_log, args.rollback_parallel)
+    results = rollback.run(originals)
+    # Volumes released at --wait-for are still followed until they complete
+    region.poller.drain(list(results))
+    return all(results.values())
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--kdu', type=str, required=True)
+    parser.add_argument('--tenant', type=str, required=True)
+    parser.add_argument('--cluster_id', type=str, required=True, nargs='+',
+                        help="Cluster UUIDs, globs on cluster UUID/name, or 'all' "
+                        "for every AWS cluster in the tenant")
+    parser.add_argument('--username', default="", type=str, required=True)
+    parser.add_argument('--password', default="", type=str, required=True)
+    parser.add_argument('--workerbatchsize', default=5, type=int, required=False)
+    parser.add_argument('--parallel-clusters', default=4, type=int, required=False,
+                        help="Maximum number of clusters migrated at the same time")
+    parser.add_argument('--region-rate', default=0, type=float, required=False,
+                        help="Maximum EC2 API calls per second per region (0: unlimited)")
+    parser.add_argument('--journal-dir', default=".", type=str, required=False,
+                        help="Directory for the per-cluster migration journal")
+    parser.add_argument('--resume', action='store_true',
+                        help="Resume from the cluster's journal, skipping finished work")
+    parser.add_argument('--wait-for', default="completed",
+                        choices=["modifying", "optimizing", "completed"],
+                        help="Volume state at which a node's migration slot is freed; "
+                        "later states are tracked in background until completion")
+    parser.add_argument('--master-wait-for', default="completed",
+                        choices=["optimizing", "completed"],
+                        help="Volume state a master's volumes must reach before the next "
+                        "master starts")
+    parser.add_argument('--no-token-cache', action='store_true',
+                        help="Don't read or write the keystone token cache in ~/.pf9")
+    parser.add_argument('--metrics-file', default=None, type=str, required=False,
+                        help="Write per-volume/API timing metrics to this JSON "
+                        "(or .csv) file")
+    parser.add_argument('--prometheus-file', default=None, type=str, required=False,
+                        help="Also write the metrics as a Prometheus textfile (.prom)")
+    parser.add_argument('--plan', action='store_true',
+                        help="Only print the volumes to migrate and an estimated "
+                        "wall-clock time, don't modify anything")
+    parser.add_argument('--size-gp3', action='store_true',
+                        help="Size each volume's gp3 IOPS/throughput from its CloudWatch "
+                        "I/O history instead of the 3000 IOPS / 125 MiB/s defaults")
+    parser.add_argument('--size-metrics-file', default=None, type=str, required=False,
+                        help="Read the I/O history for --size-gp3 from this JSON file "
+                        "instead of CloudWatch")
+    parser.add_argument('--size-days', default=14, type=int, required=False,
+                        help="Days of CloudWatch history used by --size-gp3, up to 15 "
+                        "keeps 1 minute resolution")
+    parser.add_argument('--size-headroom', default=1.2, type=float, required=False,
+                        help="Multiplier applied to the peak IOPS/throughput by --size-gp3")
+    parser.add_argument('--run-id', default=datetime.datetime.now().strftime("%Y%m%d-%H%M%S"),
+                        type=str, required=False,
+                        help="Name of this run, the original attributes of the volumes it "
+                        "modifies are saved to gp3-run-<run-id>.jsonl in --journal-dir. "
+                        "Defaults to the current time")
+    parser.add_argument('--rollback', metavar='RUN_ID', default=None, type=str,
+                        help="Revert the volumes of the selected clusters changed by "
+                        "that run to their original attributes")
+    parser.add_argument('--rollback-parallel', default=10, type=int, required=False,
+                        help="Maximum number of volumes reverted at the same time")
+
+    args = parser.parse_args()
+
+    qbertClient = QbertAPI(args.kdu, args.tenant, args.username, args.password,
+                           None if args.no_token_cache else TokenCache())
+
+    try:
+        logger.info("Fetching cluster %s information.", args.cluster_id)
+        clusters = resolve_clusters(qbertClient, args.cluster_id)
     except Exception as err:
-        logger.error("Failed to migrate volume. Error: %s", str(err))
+        logger.error("Failed to fetch clusters. Error: %s", str(err))
         raise err
+    if not clusters:
+        logger.warning("No clusters matched %s", args.cluster_id)
+        raise SystemExit(1)
+
+    metrics = None
+    if args.metrics_file or args.prometheus_file:
+        metrics = MigrationMetrics()
+
+    # One EC2 client, rate budget and poller per region
+    regions = {}
+    for cluster in clusters:
+        region = cluster_region(cluster)
+        if region not in regions:
+            regions[region] = Ec2Region(region, args.region_rate, metrics=metrics)
+    logger.info("Migrating %s clusters across regions %s", len(clusters),
+                [region or "default" for region in regions])
+
+    run_log = RunLog(args.rollback or args.run_id, args.journal_dir, prefix="gp3-run-")
+    if args.rollback and not run_log.volumes:
+        logger.error("No volumes recorded for run %s in %s", args.rollback, run_log.path)
+        raise SystemExit(1)
+    if not (args.rollback or args.plan):
+        logger.info("Run id %s, original volume attributes are saved to %s. "
+                    "Revert with --rollback %s", args.run_id, run_log.path, args.run_id)
+
+    results = {}
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, args.parallel_clusters)) as executor:
+            futures = {}
+            for cluster in clusters:
+                region = regions[cluster_region(cluster)]
+                if args.rollback:
+                    future = executor.submit(rollback_cluster, cluster, region, args,
+                                             run_log)
+                else:
+                    future = executor.submit(migrate_cluster, qbertClient, cluster,
+                                             region, args, metrics, run_log)
+                futures[future] = cluster
+            for future in concurrent.futures.as_completed(futures):
+                cluster = futures[future]
+                try:
+                    results[cluster["name"]] = future.result()
+                except Exception as err:
+                    logger.error("Failed to migrate volume. Cluster: %s Error: %s",
+                                 cluster["name"], str(err))
+                    results[cluster["name"]] = False
+    finally:
+        run_log.close()
+
+    if args.metrics_file:
+        metrics.write(args.metrics_file)
+    if args.prometheus_file:
+        metrics.write_prometheus(args.prometheus_file)
+
+    if len(clusters) > 1:
+        for name, ok in sorted(results.items()):
+            logger.info("Cluster %s: %s", name, "ok" if ok else "failed")
+    if not all(results.values()):
+        raise SystemExit(1)